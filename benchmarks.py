@@ -0,0 +1,203 @@
+import argparse
+import datetime
+import gzip
+import json
+import os
+import platform
+import random
+import time
+
+import numpy
+
+from sentiment_bot import (
+    ARTICLE_LENGTH_LOWER_LIMIT,
+    PostSentimentAnalyzer,
+    SteemClient,
+    get_reply_words,
+)
+from synthetic import SyntheticPost, get_mongo_steem, get_synthetic_corpus
+
+REPLIES = [
+    'Yes! Great find, thanks for sharing.',
+    'no, this one is just spam',
+    'stop',
+    'Nice work @{author}, resteemed.',
+    'Yes, definitely uplifting. No doubt about it.',
+    'Please stop commenting on my posts.',
+    'Thanks!',
+]
+
+
+def load_corpus(path):
+    """
+    Loads recorded posts from a JSON lines file, gzipped or not. Lines are
+    either post documents or recorder entries with the post under data.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    corpus = []
+    with opener(path, 'rt') as fh:
+        for number, line in enumerate(fh):
+            entry = json.loads(line)
+            post_data = entry.get('data', entry) if isinstance(entry, dict) else None
+            if not isinstance(post_data, dict) or 'body' not in post_data:
+                continue
+            post_data.setdefault('id', number)
+            post_data.setdefault('identifier', '{}/{}'.format(
+                post_data.get('author'), post_data.get('permlink')
+            ))
+            post_data.setdefault('allow_votes', True)
+            post_data.setdefault('depth', 0)
+            post_data.setdefault('category', 'life')
+            created = post_data.get('created')
+            if isinstance(created, str):
+                post_data['created'] = datetime.datetime.strptime(created[:19], '%Y-%m-%dT%H:%M:%S')
+            elif created is None:
+                post_data['created'] = datetime.datetime.utcnow()
+            corpus.append(post_data)
+    return corpus
+
+def get_timings(operation, items):
+    timings = []
+    started = time.perf_counter()
+    for item in items:
+        start = time.perf_counter()
+        operation(item)
+        timings.append(time.perf_counter() - start)
+    return time.perf_counter() - started, timings
+
+def summarize(total_seconds, timings):
+    return {
+        'count': len(timings),
+        'total_seconds': total_seconds,
+        'posts_per_second': len(timings) / total_seconds if total_seconds else None,
+        'p50_ms': float(numpy.percentile(timings, 50)) * 1000,
+        'p99_ms': float(numpy.percentile(timings, 99)) * 1000,
+    }
+
+
+def run_benchmarks(corpus, mongo_target='memory', write_buffer_size=50, seed=0):
+    posts = [SyntheticPost(post_data) for post_data in corpus]
+    results = {}
+
+    analyzer = PostSentimentAnalyzer()
+    sentiments = {}
+
+    def to_mongo(post):
+        sentiments[post.identifier] = analyzer.to_mongo(post)
+
+    results['to_mongo'] = summarize(*get_timings(to_mongo, posts))
+
+    # steem is only used for RPCs, which the filters do not make
+    steem_client = SteemClient(steem=object())
+    results['is_fresh_post'] = summarize(*get_timings(steem_client.is_fresh_post, posts))
+    results['is_fresh_post']['passed'] = sum(
+        1 for post in posts if steem_client.is_fresh_post(post)
+    )
+    results['is_fresh_post']['stages'] = {
+        name: dict(stats) for name, stats in steem_client.fresh_post_filter.stats.items()
+    }
+
+    rng = random.Random(seed)
+    replies = [
+        rng.choice(REPLIES).format(author=post.author) for post in posts for _ in range(10)
+    ]
+    results['reply_words'] = summarize(*get_timings(get_reply_words, replies))
+
+    mongo_steem = get_mongo_steem(mongo_target, write_buffer_size)
+    documents = []
+    for post_data in corpus:
+        document = dict(post_data)
+        document.update(sentiments[post_data['identifier']])
+        documents.append(document)
+    total_seconds, timings = get_timings(mongo_steem.store_post_data, documents)
+    start = time.perf_counter()
+    mongo_steem.flush_writes()
+    total_seconds += time.perf_counter() - start
+    results['mongo_store'] = summarize(total_seconds, timings)
+    results['mongo_store']['target'] = mongo_target
+    results['mongo_store']['write_buffer_size'] = write_buffer_size
+    mongo_steem.close()
+    return results
+
+def compare_results(previous, current, max_regression):
+    """
+    Prints throughput changes against an earlier run and returns the names
+    of the benchmarks that slowed down by more than max_regression.
+    """
+    regressions = []
+    for name, result in current['results'].items():
+        before = previous.get('results', {}).get(name, {}).get('posts_per_second')
+        after = result.get('posts_per_second')
+        if not before or not after:
+            continue
+        change = after / before - 1
+        print('  {}: {:.1f} -> {:.1f} posts/s ({:+.1%})'.format(name, before, after, change))
+        if change < -max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the filtering, scoring and storage hot paths offline.'
+    )
+    parser.add_argument('--posts', type=int, default=500, help='synthetic corpus size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--corpus', help='recorded posts as JSON lines (.jsonl or .jsonl.gz) '
+                         'to use instead of the synthetic corpus',
+    )
+    parser.add_argument(
+        '--mongo', default='memory',
+        help="'memory' for an in-memory stand-in or host:port",
+    )
+    parser.add_argument('--write-buffer-size', type=int, default=50)
+    parser.add_argument('--output', help='where to save the JSON results')
+    parser.add_argument('--compare', help='earlier results to compare against')
+    parser.add_argument(
+        '--max-regression', type=float, default=0.2,
+        help='exit with an error when throughput drops by more than this share',
+    )
+    args = parser.parse_args()
+
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+    else:
+        corpus = get_synthetic_corpus(args.posts, args.seed)
+    print('benchmarking {} posts (article length limit {} words)'.format(
+        len(corpus), ARTICLE_LENGTH_LOWER_LIMIT
+    ))
+    report = {
+        'created': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'corpus': {'source': args.corpus or 'synthetic', 'posts': len(corpus), 'seed': args.seed},
+        'results': run_benchmarks(corpus, args.mongo, args.write_buffer_size, args.seed),
+    }
+    for name, result in report['results'].items():
+        print('{}: {posts_per_second:.1f} posts/s, p50 {p50_ms:.3f}ms, p99 {p99_ms:.3f}ms'.format(
+            name, **result
+        ))
+
+    output = args.output or os.path.join(
+        'benchmark_results', 'benchmark-{}.json'.format(
+            datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        )
+    )
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+    print('saved results to {}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as fh:
+            previous = json.load(fh)
+        print('compared to {}:'.format(args.compare))
+        regressions = compare_results(previous, report, args.max_regression)
+        if regressions:
+            raise SystemExit('throughput regressed: {}'.format(', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import argparse
+
+from sentiment_bot import MongoSteem
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert stored posts to the compact storage schema.'
+    )
+    parser.add_argument('--host', default='kettle_db_1')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--db', default='steem')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument(
+        '--body', choices=['compressed', 'omit', 'full'], default=None,
+        help='how to store post bodies, defaults to [storage] body',
+    )
+    args = parser.parse_args()
+
+    mongo_steem = MongoSteem(
+        host=args.host, port=args.port, db_name=args.db, ensure_indexes=False
+    )
+    totals = mongo_steem.compact_stored_posts(
+        batch_size=args.batch_size, body_storage=args.body
+    )
+    if totals['posts']:
+        print('done: {} posts, {:.1%} of the original size'.format(
+            totals['posts'], totals['bytes_after'] / totals['bytes_before']
+        ))
+    else:
+        print('nothing to compact')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import collections
+import contextlib
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class MetricsRegistry(object):
+    """
+    Counters, gauges and latency histograms, rendered in the Prometheus text
+    exposition format.
+
+    Samples are keyed by metric name and label values. Gauges that are
+    cheaper to read when scraped than to keep current are registered with
+    set_callback and evaluated on render.
+
+    * Args
+        definitions -> (name, type, description) for every metric rendered
+        buckets -> upper bounds of the histogram buckets, in seconds
+
+    """
+    def __init__(self, definitions, buckets=DEFAULT_BUCKETS):
+        self.definitions = collections.OrderedDict(
+            (name, (metric_type, description)) for name, metric_type, description in definitions
+        )
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.callbacks = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def set_callback(self, name, callback):
+        self.callbacks[name] = callback
+
+    def get(self, name, **labels):
+        return self.values.get((name, tuple(sorted(labels.items()))))
+
+    def render(self):
+        for name, callback in list(self.callbacks.items()):
+            try:
+                self.set(name, callback())
+            except Exception as e:
+                print('could not read metric {}: {}'.format(name, e))
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted(self.histograms.items())
+        lines = []
+        for name, (metric_type, description) in self.definitions.items():
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for (sample_name, labels), value in values:
+                if sample_name == name:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+            for (sample_name, labels), histogram in histograms:
+                if sample_name != name:
+                    continue
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(labels + (('le', repr(bound)),)), count
+                    ))
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels + (('le', '+Inf'),)), histogram[-1]
+                ))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram[-2]))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        )
+        for key, value in labels
+    ))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, registry):
+        HTTPServer.__init__(self, address, MetricsHandler)
+        self.registry = registry
+
+
+_metrics_server = None
+
+
+def start_metrics_server(registry, host, port):
+    """
+    Serves registry on http://host:port/metrics from a daemon thread. Only
+    the first call in a process starts a server.
+    """
+    global _metrics_server
+    if _metrics_server is not None:
+        return _metrics_server
+    try:
+        _metrics_server = MetricsServer((host, port), registry)
+    except OSError as e:
+        print('could not serve metrics on {}:{}: {}'.format(host, port, e))
+        return None
+    threading.Thread(target=_metrics_server.serve_forever, name='metrics', daemon=True).start()
+    print('serving metrics on http://{}:{}/metrics'.format(host, port))
+    return _metrics_server
@@ -0,0 +1,37 @@
+import argparse
+
+from sentiment_bot import MongoSteem
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Ensure the bot indexes and report how the hot queries use them.'
+    )
+    parser.add_argument('--host', default='kettle_db_1')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--db', default='steem')
+    parser.add_argument(
+        '--ensure', action='store_true',
+        help='create any missing index before reporting',
+    )
+    args = parser.parse_args()
+
+    mongo_steem = MongoSteem(
+        host=args.host, port=args.port, db_name=args.db, ensure_indexes=args.ensure
+    )
+
+    print('hot queries:')
+    for name, explanation in mongo_steem.explain_hot_queries().items():
+        print('  {}: {}'.format(name, ' <- '.join(explanation['stages'])))
+        print('    keys examined: {keys_examined}, docs examined: {docs_examined}, '
+              'returned: {returned}, {millis}ms'.format(**explanation))
+        if any(stage.startswith('COLLSCAN') for stage in explanation['stages']):
+            print('    WARNING: collection scan')
+
+    print('index usage:')
+    for name, stats in mongo_steem.get_index_stats().items():
+        print('  {}: {} ops since {}'.format(name, stats['ops'], stats['since']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import collections
+import datetime
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of every thread in the process from a daemon thread.
+
+    Every interval seconds each thread's stack is folded into a collapsed
+    stack line (thread;file:function;...). Every dump_seconds the counts are
+    written to directory as a .collapsed file, ready for flamegraph.pl or
+    speedscope, and started afresh. Inclusive and self time of the functions
+    named in functions (a class name covers all its methods) accumulate for
+    the life of the process. They are also written as JSON next to the
+    stacks and, when given, passed to report after every dump.
+
+    * Args
+        interval -> seconds between samples
+        dump_seconds -> seconds between dumps
+        directory -> where the dumps are written
+        functions -> qualified names of the functions to time
+        report -> called with {label: {'total': seconds, 'self': seconds}}
+
+    """
+    def __init__(self, interval=0.01, dump_seconds=60, directory='profiles', functions=(),
+                 report=None):
+        self.interval = interval
+        self.dump_seconds = dump_seconds
+        self.directory = directory
+        self.functions = functions
+        self.report = report
+        self.stacks = collections.Counter()
+        self.function_samples = collections.defaultdict(lambda: {'total': 0, 'self': 0})
+        self.labels = {}
+        self.targets = {}
+        self.samples = 0
+        # wall time the samples cover, the sampling itself included
+        self.elapsed = 0.0
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def is_running(self):
+        return self._thread is not None and not self._stopped.is_set()
+
+    def start(self):
+        if self.is_running:
+            return
+        if self._thread is not None:
+            # a stopped sampler may still be writing its last dump
+            self._thread.join()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self._thread.start()
+        print('profiling every {:.0f}ms into {}'.format(self.interval * 1000, self.directory))
+
+    def stop(self):
+        # the sampling thread writes a last dump on its way out
+        self._stopped.set()
+
+    def toggle(self, *args):
+        if self.is_running:
+            self.stop()
+        else:
+            self.start()
+
+    def run(self):
+        dumped_at = sampled_at = time.time()
+        try:
+            while not self._stopped.wait(self.interval):
+                now = time.time()
+                self.elapsed += now - sampled_at
+                sampled_at = now
+                self.sample()
+                if now - dumped_at >= self.dump_seconds:
+                    self.dump()
+                    dumped_at = time.time()
+            self.dump()
+        finally:
+            # a sampler that died is not running either
+            self._stopped.set()
+        print('profiling stopped')
+
+    def sample(self):
+        own_ident = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        self.samples += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(self.get_label(frame))
+                frame = frame.f_back
+            if not labels:
+                continue
+            labels.reverse()
+            self.stacks[';'.join([names.get(ident, str(ident))] + labels)] += 1
+            for label in set(labels):
+                if self.targets[label]:
+                    self.function_samples[label]['total'] += 1
+            if self.targets[labels[-1]]:
+                self.function_samples[labels[-1]]['self'] += 1
+
+    def get_label(self, frame):
+        code = frame.f_code
+        label = self.labels.get(code)
+        if label is None:
+            name = get_qualified_name(code, frame)
+            label = '{}:{}'.format(os.path.basename(code.co_filename), name)
+            self.labels[code] = label
+            self.targets[label] = any(
+                name == target or name.startswith(target + '.') for target in self.functions
+            )
+        return label
+
+    def get_function_times(self):
+        # samples are interval plus the time taken to sample apart
+        seconds_per_sample = self.elapsed / self.samples if self.elapsed else self.interval
+        return {
+            label: {kind: samples * seconds_per_sample for kind, samples in counts.items()}
+            for label, counts in self.function_samples.items()
+        }
+
+    def dump(self):
+        stacks, self.stacks = self.stacks, collections.Counter()
+        if not stacks:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            prefix = os.path.join(self.directory, 'kettle-{}'.format(os.getpid()))
+            stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+            with open('{}-{}.collapsed'.format(prefix, stamp), 'w') as fh:
+                for stack, count in stacks.most_common():
+                    fh.write('{} {}\n'.format(stack, count))
+            function_times = self.get_function_times()
+            with open('{}-functions.json'.format(prefix), 'w') as fh:
+                json.dump(function_times, fh, indent=2, sort_keys=True)
+        except OSError as e:
+            print('could not write profile: {}'.format(e))
+            return
+        if self.report is not None:
+            self.report(function_times)
+
+
+def get_qualified_name(code, frame):
+    qualified_name = getattr(code, 'co_qualname', None)
+    if qualified_name:
+        return qualified_name
+    instance = frame.f_locals.get('self')
+    if instance is not None:
+        for klass in type(instance).__mro__:
+            function = klass.__dict__.get(code.co_name)
+            if getattr(function, '__code__', None) is code:
+                return '{}.{}'.format(klass.__name__, code.co_name)
+    return code.co_name
+
+
+_profiler = None
+
+
+def install_profiler(enabled=False, signal_name=None, **kwargs):
+    """
+    Creates the process profiler from kwargs, starts it when enabled and lets
+    signal_name toggle it at runtime. Must be called from the main thread;
+    later calls return the same profiler.
+    """
+    global _profiler
+    if _profiler is not None:
+        return _profiler
+    _profiler = SamplingProfiler(**kwargs)
+    toggle_signal = getattr(signal, signal_name, None) if signal_name else None
+    if toggle_signal is not None:
+        signal.signal(toggle_signal, _profiler.toggle)
+    if enabled:
+        _profiler.start()
+    return _profiler
@@ -0,0 +1,366 @@
+import argparse
+import bisect
+import collections
+import datetime
+import gzip
+import json
+import threading
+import time
+
+from steem.instance import set_shared_steemd_instance
+
+from sentiment_bot import (
+    CURATION_TRACKING, SHED_STAGES, SteemClient, SteemSentimentCommenter,
+)
+from synthetic import get_mongo_steem
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# content fields that move with the replay clock so age checks see the post
+# as exactly as old as it was when the operation was streamed
+SHIFTED_CONTENT_FIELDS = ('created', 'last_update', 'active')
+CHAIN_PARAMS = {
+    'chain_id': '0' * 64,
+    'prefix': 'STM',
+    'steem_symbol': 'STEEM',
+    'sbd_symbol': 'SBD',
+    'vests_symbol': 'VESTS',
+}
+
+
+class ReplayFinished(BaseException):
+    """
+    Raised once the recording runs out. It derives from BaseException so
+    the bot's catch-all stream recovery lets it through.
+    """
+
+
+class RecordingWriter(object):
+    """
+    Appends recorder entries to a gzipped JSON lines file. Entries are
+    tagged with the number of operations written before them so replay can
+    serve each lookup as it looked at that point of the stream.
+    """
+    def __init__(self, path):
+        self.fh = gzip.open(path, 'wt')
+        self.lock = threading.Lock()
+        self.operations = 0
+        self.counts = collections.Counter()
+
+    def write(self, kind, data, key=None):
+        entry = {'kind': kind, 'position': self.operations, 'data': data}
+        if key is not None:
+            entry['key'] = key
+        line = json.dumps(entry, default=str, sort_keys=True)
+        with self.lock:
+            self.fh.write(line + '\n')
+            self.counts[kind] += 1
+            if kind == 'operation':
+                self.operations += 1
+
+    def close(self):
+        self.fh.close()
+
+
+class RecordingSteemd(object):
+    """
+    Passes every call through to a live steemd and records the content and
+    reply lookups the bot makes.
+    """
+    def __init__(self, steemd, writer):
+        self.steemd = steemd
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.steemd, name)
+
+    def get_content(self, author, permlink):
+        content = self.steemd.get_content(author, permlink)
+        self.writer.write('content', content, key='{}/{}'.format(author, permlink))
+        return content
+
+    def get_content_replies(self, author, permlink):
+        replies = self.steemd.get_content_replies(author, permlink)
+        self.writer.write('replies', replies, key='{}/{}'.format(author, permlink))
+        return replies
+
+
+class Recording(object):
+    def __init__(self, path):
+        self.operations = []
+        self.lookups = collections.defaultdict(list)
+        with gzip.open(path, 'rt') as fh:
+            for line in fh:
+                entry = json.loads(line)
+                if entry['kind'] == 'operation':
+                    operation = entry['data']
+                    operation['timestamp'] = datetime.datetime.strptime(
+                        operation['timestamp'], TIME_FORMAT
+                    )
+                    self.operations.append(operation)
+                else:
+                    self.lookups[(entry['kind'], entry['key'])].append(
+                        (entry['position'], entry['data'])
+                    )
+
+    def get_lookup(self, kind, key, position):
+        """
+        Returns the last version of a lookup recorded at or before position,
+        or the first one recorded when the bot asks for it earlier than the
+        recorder did. None when it was never recorded.
+        """
+        versions = self.lookups.get((kind, key))
+        if not versions:
+            return None
+        index = bisect.bisect_right([recorded for recorded, _ in versions], position)
+        return versions[max(index - 1, 0)][1]
+
+    def get_span_seconds(self):
+        if len(self.operations) < 2:
+            return 0.0
+        return (self.operations[-1]['timestamp'] - self.operations[0]['timestamp']).total_seconds()
+
+
+class ReplaySteemd(object):
+    """
+    Local stand-in for steemd that answers from a Recording.
+
+    Timestamps in returned content are moved by the gap between the replay
+    clock and the recorded time of the current operation. Lookups that were
+    never recorded come back as missing content, which Post reports as
+    PostDoesNotExist.
+
+    """
+    chain_params = CHAIN_PARAMS
+
+    def __init__(self, recording):
+        self.recording = recording
+        self.position = 0
+        self.clock_offset = datetime.timedelta(0)
+        self.head_block = 0
+        self.misses = collections.Counter()
+
+    def set_clock(self, position, operation):
+        self.position = position
+        self.clock_offset = datetime.datetime.utcnow() - operation['timestamp']
+
+    def shift(self, content):
+        content = dict(content)
+        for field in SHIFTED_CONTENT_FIELDS:
+            if content.get(field):
+                recorded = datetime.datetime.strptime(content[field][:19], TIME_FORMAT)
+                content[field] = (recorded + self.clock_offset).strftime(TIME_FORMAT)
+        return content
+
+    def get_content(self, author, permlink):
+        content = self.recording.get_lookup('content', '{}/{}'.format(author, permlink), self.position)
+        if content is None:
+            self.misses['content'] += 1
+            return {'permlink': ''}
+        return self.shift(content)
+
+    def get_content_replies(self, author, permlink):
+        replies = self.recording.get_lookup('replies', '{}/{}'.format(author, permlink), self.position)
+        if replies is None:
+            self.misses['replies'] += 1
+            return []
+        return [self.shift(reply) for reply in replies]
+
+    def get_dynamic_global_properties(self):
+        return {
+            'head_block_number': self.head_block,
+            'last_irreversible_block_num': self.head_block,
+        }
+
+
+class ReplaySteemClient(SteemClient):
+    """
+    SteemClient that streams a Recording instead of the chain.
+
+    Operations are released on the recorded schedule divided by speed, or
+    as fast as the bot takes them when speed is None. Votes, comments and
+    posts are captured in actions and never sent. lag is how far, in
+    replay seconds, the bot is behind the schedule.
+
+    """
+    def __init__(self, recording, speed=None, **kwargs):
+        self.recording = recording
+        self.speed = speed
+        self.actions = []
+        self.operations_streamed = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.started = None
+        self.stream = None
+        self.max_shed_level = 0
+        super(ReplaySteemClient, self).__init__(steem=ReplaySteemd(recording), **kwargs)
+        self.load_shedder.listeners.append(self.record_shed_level)
+
+    def record_shed_level(self, level):
+        self.max_shed_level = max(self.max_shed_level, level)
+
+    def stream_comment_operations(self, checkpoint=None):
+        # the bot restarts its stream after any error; carry on where the
+        # replay was instead of starting over
+        if checkpoint is not None:
+            checkpoint.reset()
+        if self.stream is None:
+            self.stream = self.replay_operations()
+        return self.stream
+
+    def replay_operations(self):
+        self.started = time.time()
+        first = self.recording.operations[0]['timestamp'] if self.recording.operations else None
+        for position, operation in enumerate(self.recording.operations):
+            if operation['type'] not in self.operation_types:
+                continue
+            if self.speed:
+                due = self.started + (operation['timestamp'] - first).total_seconds() / self.speed
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                self.lag = max(0.0, -wait)
+                self.max_lag = max(self.max_lag, self.lag)
+            self.steem.set_clock(position, operation)
+            self.steem.head_block = operation['block_num']
+            self.operations_streamed += 1
+            # the block time on the replay clock, so lag, and the load
+            # shedding it drives, is counted in chain seconds as it is live
+            timestamp = datetime.datetime.utcnow() - datetime.timedelta(
+                seconds=self.lag * (self.speed or 1)
+            )
+            yield dict(operation, timestamp=timestamp)
+        raise ReplayFinished()
+
+    def capture(self, action, payload):
+        payload = dict(payload, action=action, position=self.steem.position)
+        self.actions.append(payload)
+
+    def reply_to(self, identifier, comment, priority=None):
+        self.capture('comment', {'identifier': identifier, 'body': comment})
+
+    def upvote_post(self, post, priority=None):
+        self.capture('vote', {'identifier': post.identifier})
+
+    def write_post(self, title, body, tags, priority=None):
+        self.capture('post', {'title': title, 'body': body, 'tags': tags})
+
+
+def record(path, operations=None, seconds=None):
+    """
+    Streams the live chain into a recording, running the fresh post filters
+    and spam checks so the lookups they make are captured too.
+    """
+    writer = RecordingWriter(path)
+    steem_client = SteemClient()
+    steemd = RecordingSteemd(steem_client.steem, writer)
+    steem_client.steem = steemd
+    set_shared_steemd_instance(steemd)
+    if CURATION_TRACKING:
+        steem_client.operation_types = ['comment', 'vote']
+    started = time.time()
+    try:
+        for operation in steem_client.stream_comment_operations():
+            writer.write(
+                'operation', dict(operation, timestamp=operation['timestamp'].strftime(TIME_FORMAT))
+            )
+            if steem_client.handle_operation(operation):
+                post = steem_client.get_fresh_post(operation)
+                if post is not None:
+                    steem_client.is_post_valid(post)
+            if operations and writer.operations >= operations:
+                break
+            if seconds and time.time() - started >= seconds:
+                break
+    except KeyboardInterrupt:
+        print('stopping recorder')
+    finally:
+        writer.close()
+    print('recorded {} to {}'.format(dict(writer.counts), path))
+
+def replay(path, speed=None, mongo='memory', ingestion_mode='sync', actions_path=None):
+    """
+    Runs SteemSentimentCommenter over a recording and returns a report of
+    its throughput, its lag behind the recorded schedule and the actions it
+    would have sent.
+    """
+    recording = Recording(path)
+    steem_client = ReplaySteemClient(recording, speed=speed)
+    set_shared_steemd_instance(steem_client.steem)
+    mongo_steem = get_mongo_steem(mongo, write_buffer_size=50, db_name='kettle_replay')
+    commenter = SteemSentimentCommenter(
+        scoring_workers=0, ingestion_mode=ingestion_mode, outbound_enabled=False,
+        steem_client=steem_client, mongo_steem=mongo_steem,
+    )
+    started = time.time()
+    try:
+        commenter.run()
+    except ReplayFinished:
+        pass
+    finally:
+        commenter.close()
+    wall_seconds = time.time() - started
+    span_seconds = recording.get_span_seconds()
+    report = {
+        'recording': path,
+        'speed': speed or 'max',
+        'ingestion_mode': ingestion_mode,
+        'operations': steem_client.operations_streamed,
+        'wall_seconds': wall_seconds,
+        'recorded_seconds': span_seconds,
+        'operations_per_second': steem_client.operations_streamed / wall_seconds,
+        # how many times faster than the chain the bot got through the
+        # recording; below 1 it would fall behind head block
+        'realtime_factor': span_seconds / wall_seconds if wall_seconds else None,
+        'max_lag_seconds': steem_client.max_lag,
+        'max_shed_stage': SHED_STAGES[steem_client.max_shed_level],
+        'final_lag_seconds': steem_client.lag,
+        'lookup_misses': dict(steem_client.steem.misses),
+        'filters': steem_client.fresh_post_filter.format_stats(),
+        'actions': dict(collections.Counter(action['action'] for action in steem_client.actions)),
+    }
+    if actions_path:
+        with open(actions_path, 'w') as fh:
+            for action in steem_client.actions:
+                fh.write(json.dumps(action, sort_keys=True) + '\n')
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Record the chain for offline runs, or replay a recording through the bot.'
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    record_parser = subparsers.add_parser('record')
+    record_parser.add_argument('path', help='recording to write, .jsonl.gz')
+    record_parser.add_argument('--operations', type=int, help='stop after this many operations')
+    record_parser.add_argument('--seconds', type=float, help='stop after this many seconds')
+    replay_parser = subparsers.add_parser('replay')
+    replay_parser.add_argument('path', help='recording to replay')
+    replay_parser.add_argument(
+        '--speed', default='max',
+        help="'max', or a multiple of the recorded pace such as 1 or 10",
+    )
+    replay_parser.add_argument(
+        '--mongo', default='memory',
+        help="'memory' for an in-memory stand-in or host:port",
+    )
+    replay_parser.add_argument('--ingestion', choices=['sync', 'async'], default='sync')
+    replay_parser.add_argument('--actions', help='write the captured actions here as JSON lines')
+    replay_parser.add_argument('--output', help='write the report here as JSON')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.path, args.operations, args.seconds)
+    elif args.command == 'replay':
+        speed = None if args.speed == 'max' else float(args.speed)
+        report = replay(args.path, speed, args.mongo, args.ingestion, args.actions)
+        print(json.dumps(report, indent=2, sort_keys=True))
+        if args.output:
+            with open(args.output, 'w') as fh:
+                json.dump(report, fh, indent=2, sort_keys=True)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import argparse
+import datetime
+
+from sentiment_bot import MongoSteem, PostSentimentAnalyzer
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rescore stored posts with the current thresholds and lexicon.'
+    )
+    parser.add_argument('--host', default='kettle_db_1')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--db', default='steem')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument(
+        '--hours', type=float, default=None,
+        help='only rescore posts created in the last this many hours',
+    )
+    parser.add_argument(
+        '--sampled', action='store_true',
+        help='only rescore posts scored from a sentence sample while shedding load',
+    )
+    args = parser.parse_args()
+
+    query = {}
+    if args.hours:
+        query['created'] = {
+            '$gt': datetime.datetime.now() - datetime.timedelta(hours=args.hours)
+        }
+    if args.sampled:
+        query['sentence_sample'] = {'$exists': True}
+    mongo_steem = MongoSteem(
+        host=args.host, port=args.port, db_name=args.db, ensure_indexes=False
+    )
+    totals = mongo_steem.rescore_stored_posts(
+        PostSentimentAnalyzer(), query=query, batch_size=args.batch_size
+    )
+    print('done: {posts} posts rescored, {flipped} changed positive outlier, '
+          '{skipped} skipped'.format(**totals))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,140 @@
+import asyncio
+import collections
 import configparser
 import datetime
+import hashlib
+import itertools
 import json
+import multiprocessing
 import random
+import re
 import string
+import sys
+import threading
 import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import langdetect
+import numpy
 from langdetect.lang_detect_exception import LangDetectException
 from nltk.sentiment.vader import SentimentIntensityAnalyzer
 from nltk import tokenize
-from pymongo import MongoClient
+from bson import BSON
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import (
+    BulkWriteError, ConnectionFailure, DuplicateKeyError, OperationFailure,
+)
 from steembase.exceptions import PostDoesNotExist
 from steem import Steem
+from steem.amount import Amount
+from steem.blockchain import Blockchain
+from steem.instance import set_shared_steemd_instance
 from steem.post import Post
 
+from metrics import MetricsRegistry, start_metrics_server
+from profiler import install_profiler
+
 config = configparser.ConfigParser()
 config.read('config.ini')
+
+
+def get_config_value(section, key, default, cast=str):
+    value = config.get(section, key, fallback='').strip()
+    if not value:
+        return default
+    return cast(value)
+
+
+def config_flag(value):
+    return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+
+
 POSTING_KEY = config['steem']['posting_key']
 POSITIVE_THRESHOLD = float(config['steem']['positive_threshold'])
 NEGATIVE_THRESHOLD = float(config['steem']['negative_threshold'])
 ARTICLE_LENGTH_LOWER_LIMIT = int(config['steem'].get('article_length_lower_limit')) or 500
 EXPIRATION_MINUTES = int(config['steem'].get('expiration_minutes')) or 15
 ACCOUNT = config['steem']['account']
+FRESH_POST_FILTER_ORDER = get_config_value(
+    'filters', 'order',
+    ['category', 'priority', 'allow_votes', 'depth', 'age', 'length', 'language'],
+    lambda value: [name.strip() for name in value.split(',') if name.strip()],
+)
+FILTER_REPORT_EVERY = get_config_value('filters', 'report_every', 1000, int)
+LANGUAGE_SAMPLE_CHARS = get_config_value('language', 'sample_chars', 1000, int)
+LANGUAGE_ENGLISH_THRESHOLD = get_config_value('language', 'english_threshold', 0.2, float)
+LANGUAGE_OTHER_THRESHOLD = get_config_value('language', 'other_threshold', 0.12, float)
+LANGUAGE_AUDIT_EVERY = get_config_value('language', 'audit_every', 200, int)
+LANGUAGE_SEED = get_config_value('language', 'seed', 0, int)
+INGESTION_MODE = get_config_value('ingestion', 'mode', 'sync')
+INGESTION_MAX_IN_FLIGHT = get_config_value('ingestion', 'max_in_flight', 16, int)
+INGESTION_QUEUE_SIZE = get_config_value('ingestion', 'queue_size', 64, int)
+MONGO_POOL_SIZE = get_config_value('mongo', 'pool_size', 10, int)
+MONGO_CONNECT_TIMEOUT_MS = get_config_value('mongo', 'connect_timeout_ms', 5000, int)
+MONGO_SOCKET_TIMEOUT_MS = get_config_value('mongo', 'socket_timeout_ms', 10000, int)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = get_config_value(
+    'mongo', 'server_selection_timeout_ms', 5000, int
+)
+MONGO_RETRIES = get_config_value('mongo', 'retries', 3, int)
+MONGO_RETRY_BACKOFF = get_config_value('mongo', 'retry_backoff', 0.5, float)
+RESTART_BACKOFF = get_config_value('restart', 'backoff', 5, float)
+RESTART_MAX_BACKOFF = get_config_value('restart', 'max_backoff', 300, float)
+RESTART_STABLE_SECONDS = get_config_value('restart', 'stable_seconds', 600, float)
+UNSUBSCRIBED_REFRESH_SECONDS = get_config_value(
+    'mongo', 'unsubscribed_refresh_seconds', 300, float
+)
+SEEN_POSTS_MAX_ENTRIES = get_config_value('dedup', 'max_entries', 100000, int)
+SEEN_POSTS_MARGIN_MINUTES = get_config_value('dedup', 'margin_minutes', 5, float)
+# with a celery broker configured the storage workers write posts too
+SEEN_POSTS_SINGLE_WRITER = get_config_value(
+    'dedup', 'single_writer', not config.get('celery', 'broker', fallback='').strip(), config_flag
+)
+MONGO_ENSURE_INDEXES = get_config_value('mongo', 'ensure_indexes', True, config_flag)
+WRITE_BUFFER_SIZE = get_config_value('mongo', 'write_buffer_size', 50, int)
+WRITE_BUFFER_SECONDS = get_config_value('mongo', 'write_buffer_seconds', 5, float)
+REFRESH_WORKERS = get_config_value('refresh', 'workers', 8, int)
+REFRESH_BATCH_SIZE = get_config_value('refresh', 'batch_size', 100, int)
+REFRESH_REPORT_EVERY = get_config_value('refresh', 'report_every', 1000, int)
+STORAGE_COMPACT = get_config_value('storage', 'compact', False, config_flag)
+STORAGE_BODY = get_config_value('storage', 'body', 'compressed')
+STORAGE_COMPRESSION_LEVEL = get_config_value('storage', 'compression_level', 6, int)
+REPLY_CACHE_TTL_SECONDS = get_config_value('replies', 'cache_ttl_seconds', 600, float)
+REPLY_CACHE_MAX_ENTRIES = get_config_value('replies', 'cache_max_entries', 10000, int)
+REPLY_FETCH_WORKERS = get_config_value('replies', 'fetch_workers', 8, int)
+ROUNDUP_HOUR = get_config_value('roundup', 'hour', 13, int)
+ROUNDUP_WORKERS = get_config_value('roundup', 'workers', 8, int)
+CURATION_TRACKING = get_config_value('curation', 'tracking', True, config_flag)
+CURATION_WINDOW_HOURS = get_config_value('curation', 'window_hours', 48, float)
+OUTBOUND_ENABLED = get_config_value('outbound', 'enabled', True, config_flag)
+OUTBOUND_INTERVALS = {
+    'vote': get_config_value('outbound', 'vote_interval', 3, float),
+    'comment': get_config_value('outbound', 'comment_interval', 20, float),
+    'post': get_config_value('outbound', 'post_interval', 300, float),
+}
+OUTBOUND_BURST = get_config_value('outbound', 'burst', 1, int)
+OUTBOUND_MAX_ATTEMPTS = get_config_value('outbound', 'max_attempts', 5, int)
+OUTBOUND_RETRY_BACKOFF = get_config_value('outbound', 'retry_backoff', 30, float)
+OUTBOUND_POLL_SECONDS = get_config_value('outbound', 'poll_seconds', 5, float)
+CHECKPOINT_EVERY_BLOCKS = get_config_value('checkpoint', 'every_blocks', 20, int)
+CHECKPOINT_EVERY_SECONDS = get_config_value('checkpoint', 'every_seconds', 30, float)
+CHECKPOINT_CATCH_UP = get_config_value('checkpoint', 'catch_up', 'fresh')
+SCORING_WORKERS = get_config_value('scoring', 'workers', 0, int)
+SCORING_ORDERED = get_config_value('scoring', 'ordered', True, config_flag)
+SCORING_MAX_PENDING = get_config_value('scoring', 'max_pending', 64, int)
+METRICS_ENABLED = get_config_value('metrics', 'enabled', True, config_flag)
+METRICS_HOST = get_config_value('metrics', 'host', '127.0.0.1')
+METRICS_PORT = get_config_value('metrics', 'port', 9108, int)
+HEAD_BLOCK_REFRESH_SECONDS = get_config_value('metrics', 'head_block_refresh_seconds', 10, float)
+PROFILING_ENABLED = get_config_value('profiling', 'enabled', False, config_flag)
+PROFILING_INTERVAL_MS = get_config_value('profiling', 'interval_ms', 10, float)
+PROFILING_DUMP_SECONDS = get_config_value('profiling', 'dump_seconds', 60, float)
+PROFILING_DIRECTORY = get_config_value('profiling', 'directory', 'profiles')
+PROFILING_SIGNAL = get_config_value('profiling', 'signal', 'SIGUSR2')
+PROFILING_FUNCTIONS = get_config_value(
+    'profiling', 'functions', ['PostSentimentAnalyzer', 'SteemClient.is_fresh_post', 'MongoSteem'],
+    lambda value: [name.strip() for name in value.split(',') if name.strip()],
+)
 POST_CATEGORIES = set([
     'altcoin', 'bitshares', 'btc', 'business', 'crypto-news', 'curation',
     'esteem', 'happy', 'steemit', 'bitcoin', 'introduceyourself', 'cryptocurrency', 'steem',
@@ -29,8 +142,161 @@ POST_CATEGORIES = set([
     'blockchain', 'technology', 'science', 'sports'
 ])
 EXCLUDE_CATEGORIES = set(['nsfw'])
+SHEDDING_ENABLED = get_config_value('shedding', 'enabled', True, config_flag)
+# seconds of stream lag at which each shed stage starts; irreversible blocks
+# are already about a minute old when they are streamed
+SHEDDING_THRESHOLDS = get_config_value(
+    'shedding', 'thresholds', [180.0, 300.0, 480.0],
+    lambda value: [float(threshold) for threshold in value.split(',') if threshold.strip()],
+)
+SHEDDING_RECOVER_RATIO = get_config_value('shedding', 'recover_ratio', 0.75, float)
+SHEDDING_SENTENCE_SAMPLE = get_config_value('shedding', 'sentence_sample', 40, int)
+PRIORITY_CATEGORIES = get_config_value(
+    'shedding', 'priority_categories', POST_CATEGORIES,
+    lambda value: set(category.strip() for category in value.split(',') if category.strip()),
+)
+SHED_STAGES = ('full', 'skip_spam_check', 'sample_sentences', 'priority_only')
 SPAM_DETECTORS = set(['badcontent'])
+BLOCKS_PER_MINUTE = 20
+DUPLICATE_KEY_ERROR = 11000
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+# (collection, keys, options) for every index the bot's queries rely on
+MONGO_INDEXES = [
+    ('posts', [('id', ASCENDING)], {'name': 'id_unique', 'unique': True}),
+    ('posts', [('identifier', ASCENDING)], {'name': 'identifier_unique', 'unique': True}),
+    (
+        'posts',
+        [('is_pos_outlier', ASCENDING), ('created', DESCENDING)],
+        {
+            'name': 'positive_roundup',
+            'partialFilterExpression': {'is_pos_outlier': True},
+        },
+    ),
+    ('posts', [('created', DESCENDING)], {'name': 'created'}),
+    (
+        'posts',
+        [('bot_comment', ASCENDING)],
+        {
+            'name': 'bot_comment',
+            'partialFilterExpression': {'bot_comment': {'$exists': True}},
+        },
+    ),
+    (
+        'users',
+        [('unsubscribed', ASCENDING), ('user', ASCENDING)],
+        {
+            'name': 'unsubscribed_users',
+            'partialFilterExpression': {'unsubscribed': True},
+        },
+    ),
+    (
+        'outbound',
+        [('status', ASCENDING), ('priority', ASCENDING), ('created', ASCENDING)],
+        {'name': 'outbound_queue'},
+    ),
+]
+# (collection, name) of indexes earlier versions created that no query uses
+OBSOLETE_MONGO_INDEXES = [
+    ('users', 'user_unsubscribed'),
+]
+# Frequent English trigrams that are rare in the other latin-script languages
+# langdetect profiles, used to settle the obvious cases without langdetect.
+ENGLISH_TRIGRAMS = frozenset([
+    ' an', ' be', ' it', ' my', ' of', ' th', ' to', ' we', ' wh', ' yo',
+    'and', 'are', 'at ', 'ave', 'by ', 'ded', 'ear', 'ed ', 'ere', 'fro',
+    'ght', 'hat', 'hav', 'he ', 'her', 'hic', 'hin', 'his', 'ich', 'igh',
+    'ike', 'ing', 'ink', 'is ', 'it ', 'ith', 'kno', 'lly', 'ly ', 'my ',
+    'nd ', 'ng ', 'now', 'of ', 'ome', 'oth', 'ou ', 'oul', 'out', 'own',
+    'rom', 'ted', 'tha', 'the', 'thi', 'thr', 'to ', 'ugh', 'uld', 'uth',
+    've ', 'ver', 'was', 'we ', 'wer', 'whi', 'who', 'wit', 'wou', 'you',
+])
+MARKDOWN_PATTERNS = [
+    (re.compile(r'```.*?(```|$)', re.S), ' '),
+    (re.compile(r'`[^`]*`'), ' '),
+    (re.compile(r'!\[[^\]]*\]\([^)]*\)'), ' '),
+    (re.compile(r'\[([^\]]*)\]\([^)]*\)'), r'\1'),
+    (re.compile(r'<[^>]*>'), ' '),
+    (re.compile(r'https?://\S+'), ' '),
+    (re.compile(r'[\W\d_]+'), ' '),
+]
+POLARITY_KEYS = ('pos', 'neg', 'neu', 'compound')
+SECONDS_PER_BLOCK = 3
+METRIC_DEFINITIONS = [
+    ('kettle_operations_total', 'counter', 'Operations streamed from the chain, by type.'),
+    ('kettle_posts_seen_total', 'counter', 'Posts checked by the fresh post filters.'),
+    ('kettle_posts_filtered_total', 'counter', 'Posts rejected by the fresh post filters, by stage.'),
+    ('kettle_posts_fresh_total', 'counter', 'Posts that passed every fresh post filter.'),
+    ('kettle_posts_scored_total', 'counter', 'Posts scored by the sentiment analyzer.'),
+    ('kettle_posts_handled_total', 'counter', 'Posts stored by the commenter, by outcome.'),
+    ('kettle_stage_seconds', 'histogram', 'Time spent in langdetect, tokenization and VADER.'),
+    ('kettle_mongo_seconds', 'histogram', 'Mongo call latency, by operation.'),
+    ('kettle_mongo_errors_total', 'counter', 'Failed Mongo calls, by operation.'),
+    ('kettle_rpc_seconds', 'histogram', 'Steem RPC latency, by method.'),
+    ('kettle_rpc_errors_total', 'counter', 'Failed Steem RPC calls, by method.'),
+    ('kettle_outbound_actions_total', 'counter', 'Outbound actions, by action and result.'),
+    ('kettle_outbound_queue_depth', 'gauge', 'Outbound actions waiting to be sent.'),
+    ('kettle_ingestion_queue_size', 'gauge', 'Posts waiting in the async ingestion queue.'),
+    ('kettle_block_lag_blocks', 'gauge', 'Blocks between head and the last streamed operation.'),
+    ('kettle_stream_lag_seconds', 'gauge', 'Wall clock minus the timestamp of the last streamed block.'),
+    ('kettle_shed_level', 'gauge', 'Current load shedding stage, 0 for full fidelity.'),
+    ('kettle_shed_transitions_total', 'counter', 'Load shedding stage changes, by stage.'),
+    ('kettle_profile_seconds', 'counter', 'Sampled wall time of profiled functions, by kind.'),
+]
+COMPACT_STORAGE_VERSION = 2
+PACKED_SCORE_DTYPE = numpy.dtype('<f4')
+# export fields kept in compact storage, everything else the chain returns
+# can be fetched again with Post(identifier)
+STORED_POST_FIELDS = frozenset([
+    'id', 'identifier', 'author', 'permlink', 'parent_author', 'parent_permlink',
+    'category', 'title', 'url', 'created', 'last_update', 'depth', 'tags',
+    'net_votes', 'children', 'body',
+])
+# enough of a stored post to rebuild it with Post(post_data)
+POST_RECORD_PROJECTION = {'identifier': 1, 'author': 1, 'permlink': 1, 'url': 1, 'created': 1}
+# fields the bot adds on top of the export
+BOT_POST_FIELDS = frozenset([
+    '_id', 'polarities', 'normalized_polarities', 'overall_polarity',
+    'is_pos_outlier', 'is_neg_outlier', 'is_in_positive_article_post',
+    'bot_comment', 'curation', 'storage_version', 'body_z', 'body_length', 'sentence_sample',
+])
+SCORE_DTYPE = numpy.dtype([
+    ('identifier', object),
+    ('sentences', numpy.int32),
+    ('pos', numpy.float64),
+    ('neg', numpy.float64),
+    ('neu', numpy.float64),
+    ('compound', numpy.float64),
+    ('avg_normalized_polarity', numpy.float64),
+    ('is_pos_outlier', numpy.bool_),
+    ('is_neg_outlier', numpy.bool_),
+])
+
+
+METRICS = MetricsRegistry(METRIC_DEFINITIONS)
+
+
+def record_profile_times(function_times):
+    for label, times in function_times.items():
+        for kind, seconds in times.items():
+            METRICS.set('kettle_profile_seconds', seconds, function=label, kind=kind)
 
+def instrument_steemd(steemd):
+    """
+    Times every RPC made through steemd under its method name.
+    """
+    call = steemd.call
+
+    def timed_call(name, *args, **kwargs):
+        try:
+            with METRICS.timer('kettle_rpc_seconds', method=name):
+                return call(name, *args, **kwargs)
+        except Exception:
+            METRICS.inc('kettle_rpc_errors_total', method=name)
+            raise
+
+    steemd.call = timed_call
+    return steemd
 
 def convert_post_datetime(post_datetime_str):
     return datetime.datetime.strptime(
@@ -43,15 +309,626 @@ def datetime_filter(start_time, end_time=None):
     start_time = start_time + datetime.timedelta(hours=6)
     return {"created": {"$gte": start_time, "$lte": end_time}}
 
+def pack_scores(values):
+    return numpy.asarray(values, dtype=PACKED_SCORE_DTYPE).tobytes()
+
+def unpack_scores(data):
+    return numpy.frombuffer(data, dtype=PACKED_SCORE_DTYPE)
+
+def compact_post_data(post_data, body=STORAGE_BODY):
+    """
+    Converts a post document to the compact storage schema in place.
+
+    Sentence scores are packed into little-endian float32 bytes, one row of
+    POLARITY_KEYS per sentence. The body is zlib compressed into body_z,
+    dropped, or kept as is depending on body.
+
+    * Args
+        * post_data -> post document, as built for store_post_data
+        * body -> 'compressed', 'omit' or 'full'
+
+    """
+    if isinstance(post_data.get('polarities'), list):
+        post_data['polarities'] = pack_scores([
+            [polarity[key] for key in POLARITY_KEYS] for polarity in post_data['polarities']
+        ])
+    if isinstance(post_data.get('normalized_polarities'), list):
+        post_data['normalized_polarities'] = pack_scores(post_data['normalized_polarities'])
+    if 'body' in post_data and body != 'full':
+        text = post_data.pop('body')
+        post_data['body_length'] = len(text)
+        if body == 'compressed':
+            post_data['body_z'] = zlib.compress(text.encode('utf-8'), STORAGE_COMPRESSION_LEVEL)
+    post_data['storage_version'] = COMPACT_STORAGE_VERSION
+    return post_data
+
+def expand_post_data(post_data):
+    """
+    Turns a compact post document back into the plain schema in place.
+    Documents in the plain schema are returned unchanged.
+    """
+    if post_data.get('storage_version') != COMPACT_STORAGE_VERSION:
+        return post_data
+    if isinstance(post_data.get('polarities'), bytes):
+        post_data['polarities'] = [
+            dict(zip(POLARITY_KEYS, row.tolist()))
+            for row in unpack_scores(post_data['polarities']).reshape(-1, len(POLARITY_KEYS))
+        ]
+    if isinstance(post_data.get('normalized_polarities'), bytes):
+        post_data['normalized_polarities'] = unpack_scores(
+            post_data['normalized_polarities']
+        ).tolist()
+    if 'body_z' in post_data:
+        post_data['body'] = zlib.decompress(post_data.pop('body_z')).decode('utf-8')
+    return post_data
+
+def sample_sentences(sentences, limit):
+    """
+    Returns at most limit sentences spread evenly over the post, keeping
+    the first and the last one.
+    """
+    if not limit or len(sentences) <= limit:
+        return sentences
+    if limit == 1:
+        return sentences[:1]
+    step = (len(sentences) - 1) / (limit - 1)
+    return [sentences[int(round(index * step))] for index in range(limit)]
+
+def get_reply_words(body):
+    table = str.maketrans(dict.fromkeys(string.punctuation))
+    return set(body.translate(table).lower().split(' '))
+
+def get_curation_deltas(is_yes, is_no):
+    """
+    Returns the tally increments for one yes and/or no reply. score is
+    yes minus no, so the roundup can test it with a plain indexed range.
+    """
+    deltas = {'curation.score': int(is_yes) - int(is_no)}
+    if is_yes:
+        deltas['curation.yes'] = 1
+    if is_no:
+        deltas['curation.no'] = 1
+    return deltas
+
+def get_vote_requests(query, voter, weight, deltas):
+    """
+    Builds guarded updates that move voter between the up and down voter
+    sets of the matched post and apply deltas once per net vote change.
+    Replaying the same vote operation matches nothing the second time.
+
+    * Args
+        * query -> filter selecting the post document
+        * voter -> key recorded in curation.upvoters / curation.downvoters
+        * weight -> vote weight from the operation, 0 for an unvote
+        * deltas -> fields to $inc for every net vote gained
+
+    """
+    def inc(sign):
+        return {field: sign * delta for field, delta in deltas.items()}
+
+    def guarded(condition):
+        guarded_query = dict(query)
+        guarded_query.update(condition)
+        return guarded_query
+
+    requests = []
+    if weight >= 0:
+        requests.append(UpdateOne(
+            guarded({'curation.downvoters': voter}),
+            {'$pull': {'curation.downvoters': voter}, '$inc': inc(1)},
+        ))
+    if weight <= 0:
+        requests.append(UpdateOne(
+            guarded({'curation.upvoters': voter}),
+            {'$pull': {'curation.upvoters': voter}, '$inc': inc(-1)},
+        ))
+    if weight > 0:
+        requests.append(UpdateOne(
+            guarded({'curation.upvoters': {'$ne': voter}}),
+            {'$addToSet': {'curation.upvoters': voter}, '$inc': inc(1)},
+        ))
+    if weight < 0:
+        requests.append(UpdateOne(
+            guarded({'curation.downvoters': {'$ne': voter}}),
+            {'$addToSet': {'curation.downvoters': voter}, '$inc': inc(-1)},
+        ))
+    return requests
+
 def vote_count_filter(vote_count):
     return {"$where": "this.active_votes.length > {}".format(vote_count)}
 
+class PostFilterChain(object):
+    """
+    Runs named post predicates in order, stopping at the first rejection.
+
+    Stages run in the configured order, and any stage left out of it is
+    appended in registration order, so the cheap checks can be put in front
+    of the expensive ones without disabling anything by accident. Each stage
+    keeps counters of how many posts it checked and rejected and how long it
+    spent doing so.
+
+    * Args
+        * stages -> list of (name, predicate) pairs; a predicate takes a post
+            and returns True when the post should go through
+        * order -> list of stage names to run first
+        * on_reject -> optional callable taking the name of the rejecting stage
+
+    """
+    def __init__(self, stages, order=None, on_reject=None):
+        self.stages = collections.OrderedDict()
+        self.stats = {}
+        self.order = []
+        self.on_reject = on_reject
+        for name, predicate in stages:
+            self.add_stage(name, predicate)
+        self.set_order(order or [])
+
+    def add_stage(self, name, predicate, before=None):
+        self.stages[name] = predicate
+        self.stats[name] = {'checked': 0, 'rejected': 0, 'seconds': 0.0}
+        order = [stage for stage in self.order if stage != name]
+        if before in order:
+            order.insert(order.index(before), name)
+        else:
+            order.append(name)
+        self.order = order
+
+    def set_order(self, order):
+        unknown = [name for name in order if name not in self.stages]
+        if unknown:
+            raise KeyError('unknown post filters: {}'.format(', '.join(unknown)))
+        self.order = list(order) + [name for name in self.stages if name not in order]
+
+    def __call__(self, post):
+        for name in self.order:
+            stats = self.stats[name]
+            start = time.perf_counter()
+            try:
+                passed = self.stages[name](post)
+            finally:
+                stats['checked'] += 1
+                stats['seconds'] += time.perf_counter() - start
+            if not passed:
+                stats['rejected'] += 1
+                if self.on_reject is not None:
+                    self.on_reject(name)
+                return False
+        return True
+
+    def format_stats(self):
+        return ', '.join(
+            '{}: {}/{} rejected in {:.3f}s'.format(
+                name,
+                self.stats[name]['rejected'],
+                self.stats[name]['checked'],
+                self.stats[name]['seconds'],
+            )
+            for name in self.order
+        )
+
+
+class LanguageGate(object):
+    """
+    Decides whether a post body is English at a bounded cost.
+
+    Only the first sample_chars characters of the markdown-stripped body are
+    looked at. The share of ENGLISH_TRIGRAMS in that sample settles the clear
+    cases; samples that land between the two thresholds go to langdetect,
+    which is seeded so the same post always gets the same answer. Every
+    audit_every-th decision is also checked against langdetect on the full
+    body so the agreement rate of the gate can be watched.
+
+    """
+    def __init__(self, sample_chars=LANGUAGE_SAMPLE_CHARS,
+                 english_threshold=LANGUAGE_ENGLISH_THRESHOLD,
+                 other_threshold=LANGUAGE_OTHER_THRESHOLD,
+                 audit_every=LANGUAGE_AUDIT_EVERY, seed=LANGUAGE_SEED):
+        self.sample_chars = sample_chars
+        self.english_threshold = english_threshold
+        self.other_threshold = other_threshold
+        self.audit_every = audit_every
+        langdetect.DetectorFactory.seed = seed
+        # langdetect loads its profiles on first use without a lock, so
+        # concurrent first calls can classify against a half loaded factory
+        langdetect.detector_factory.init_factory()
+        self.stats = {
+            'checked': 0,
+            'fast_english': 0,
+            'fast_other': 0,
+            'ambiguous': 0,
+            'undetectable': 0,
+            'audited': 0,
+            'agreed': 0,
+            'seconds': 0.0,
+        }
+
+    def get_sample(self, text):
+        # markdown and links can take up far more room than the prose, so
+        # strip a larger window than the sample we keep
+        text = text[:self.sample_chars * 4]
+        for pattern, replacement in MARKDOWN_PATTERNS:
+            text = pattern.sub(replacement, text)
+        return ' {} '.format(text.lower().strip()[:self.sample_chars])
+
+    def get_english_ratio(self, sample):
+        trigram_count = len(sample) - 2
+        if trigram_count <= 1:
+            return 0.0
+        hits = sum(
+            1 for index in range(trigram_count)
+            if sample[index:index + 3] in ENGLISH_TRIGRAMS
+        )
+        return hits / trigram_count
+
+    def is_english(self, text):
+        start = time.perf_counter()
+        self.stats['checked'] += 1
+        sample = self.get_sample(text)
+        ratio = self.get_english_ratio(sample)
+        if ratio >= self.english_threshold:
+            self.stats['fast_english'] += 1
+            is_english = True
+        elif ratio <= self.other_threshold:
+            self.stats['fast_other'] += 1
+            is_english = False
+        else:
+            self.stats['ambiguous'] += 1
+            is_english = self.detect(sample) == 'en'
+        self.stats['seconds'] += time.perf_counter() - start
+        if self.audit_every and self.stats['checked'] % self.audit_every == 0:
+            self.audit(text, is_english)
+        return is_english
+
+    def detect(self, text):
+        try:
+            with METRICS.timer('kettle_stage_seconds', stage='langdetect'):
+                return langdetect.detect(text)
+        except LangDetectException:
+            self.stats['undetectable'] += 1
+            return None
+
+    def audit(self, text, is_english):
+        try:
+            with METRICS.timer('kettle_stage_seconds', stage='langdetect'):
+                language = langdetect.detect(text)
+        except LangDetectException:
+            return
+        self.stats['audited'] += 1
+        if is_english == (language == 'en'):
+            self.stats['agreed'] += 1
+
+    @property
+    def agreement_rate(self):
+        if not self.stats['audited']:
+            return None
+        return self.stats['agreed'] / self.stats['audited']
+
+    @property
+    def mean_latency(self):
+        if not self.stats['checked']:
+            return 0.0
+        return self.stats['seconds'] / self.stats['checked']
+
+    def format_stats(self):
+        return (
+            '{checked} checked, {fast_english} fast english, {fast_other} fast '
+            'other, {ambiguous} ambiguous, {undetectable} undetectable, '
+            '{latency:.2f}ms mean, {agreement} agreement over {audited} audits'.format(
+                latency=self.mean_latency * 1000,
+                agreement=(
+                    'n/a' if self.agreement_rate is None
+                    else '{:.1%}'.format(self.agreement_rate)
+                ),
+                **self.stats
+            )
+        )
+
+
+class StreamCheckpoint(object):
+    """
+    Tracks the last fully processed block of the comment stream in Mongo.
+
+    Every operation read from the stream is registered with start and
+    released with finish once its post has been handled or filtered out.
+    The safe block is the newest block with nothing outstanding and nothing
+    left to read. It is written to the state collection every every_blocks
+    blocks or every_seconds seconds, whichever comes first, and on flush.
+    Posts may be started and finished from different threads, such as the
+    scoring pool's feeder and the main loop, so all of it runs under a lock.
+
+    * Args
+        * catch_up -> how to resume from a stored block:
+            * full -> process every block since the checkpoint
+            * fresh -> skip blocks too old to hold posts younger than
+                EXPIRATION_MINUTES; when the stream has operation handlers
+                they still see those blocks and only the post filters skip
+                them, see is_stale
+            * head -> ignore the checkpoint and start from head
+
+    """
+    def __init__(self, mongo_steem, name='comment_stream',
+                 every_blocks=CHECKPOINT_EVERY_BLOCKS,
+                 every_seconds=CHECKPOINT_EVERY_SECONDS,
+                 catch_up=CHECKPOINT_CATCH_UP):
+        self.mongo_steem = mongo_steem
+        self.name = name
+        self.every_blocks = every_blocks
+        self.every_seconds = every_seconds
+        self.catch_up = catch_up
+        self.safe_block = None
+        self.written_block = None
+        self.written_at = time.time()
+        self.reading_block = None
+        self.outstanding = collections.Counter()
+        self.fresh_block = None
+        # reentrant: finish and start advance, and advance flushes
+        self._lock = threading.RLock()
+
+    def load(self):
+        state = self.mongo_steem.retry(
+            self.mongo_steem.state.find_one, {'_id': self.name}
+        )
+        if state:
+            return state['block_num']
+
+    def get_start_block(self, head_block_num, replay_operations=False):
+        """
+        Returns the block the stream should (re)start from, or None for head.
+        With replay_operations the fresh catch up starts at the checkpoint
+        too, and is_stale tells the caller which blocks to keep from the
+        post filters.
+        """
+        self.fresh_block = None
+        if self.catch_up == 'head':
+            return None
+        last_block = self.safe_block
+        if last_block is None:
+            last_block = self.load()
+        if last_block is None:
+            return None
+        start_block = last_block + 1
+        if self.catch_up == 'fresh':
+            fresh_block = head_block_num - EXPIRATION_MINUTES * BLOCKS_PER_MINUTE
+            if replay_operations:
+                self.fresh_block = fresh_block
+            else:
+                start_block = max(start_block, fresh_block)
+        print('resuming comment stream at block {} ({} behind head)'.format(
+            start_block, head_block_num - start_block
+        ))
+        return start_block
+
+    def is_stale(self, block_num):
+        return self.fresh_block is not None and block_num < self.fresh_block
+
+    def skip(self, block_num):
+        """
+        Counts an operation the post filters never see as done.
+        """
+        with self._lock:
+            self.start(block_num)
+            self.finish(block_num)
+
+    def reset(self):
+        with self._lock:
+            self.reading_block = None
+            self.outstanding.clear()
+
+    def start(self, block_num):
+        with self._lock:
+            if self.reading_block is not None and block_num > self.reading_block:
+                self.advance(block_num - 1)
+            self.reading_block = block_num
+            self.outstanding[block_num] += 1
+
+    def finish(self, block_num):
+        with self._lock:
+            if block_num not in self.outstanding:
+                return
+            self.outstanding[block_num] -= 1
+            if not self.outstanding[block_num]:
+                del self.outstanding[block_num]
+                if self.outstanding:
+                    self.advance(min(self.outstanding) - 1)
+                elif self.reading_block is not None:
+                    self.advance(self.reading_block - 1)
+
+    def advance(self, block_num):
+        with self._lock:
+            if self.outstanding:
+                block_num = min(block_num, min(self.outstanding) - 1)
+            if self.safe_block is not None and block_num <= self.safe_block:
+                return
+            self.safe_block = block_num
+            if (
+                self.written_block is None
+                or self.safe_block - self.written_block >= self.every_blocks
+                or time.time() - self.written_at >= self.every_seconds
+            ):
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self.safe_block is None or self.safe_block == self.written_block:
+                return
+            # never let the checkpoint get ahead of posts still sitting in the
+            # write buffer
+            self.mongo_steem.flush_writes()
+            self.mongo_steem.retry(
+                self.mongo_steem.state.update_one,
+                {'_id': self.name},
+                {'$set': {'block_num': self.safe_block, 'updated': datetime.datetime.now()}},
+                upsert=True,
+            )
+            self.written_block = self.safe_block
+            self.written_at = time.time()
+
+
+class ReplyFetcher(object):
+    """
+    Fetches first-level replies with a TTL cache keyed by post identifier.
+
+    A get_replies call costs one get_content_replies round trip plus one
+    get_content per reply, so the same reply tree is only fetched once per
+    ttl_seconds. get_replies_many fetches every uncached tree of a batch
+    concurrently on up to workers threads. Hits, misses and time spent in
+    RPCs are counted in stats.
+
+    """
+    def __init__(self, ttl_seconds=REPLY_CACHE_TTL_SECONDS,
+                 max_entries=REPLY_CACHE_MAX_ENTRIES, workers=REPLY_FETCH_WORKERS):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.workers = workers
+        self.stats = {'hits': 0, 'misses': 0, 'rpc_seconds': 0.0}
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_cached(self, post):
+        with self._lock:
+            cached = self._cache.get(post.identifier)
+            if cached is not None and time.time() - cached[0] < self.ttl_seconds:
+                self.stats['hits'] += 1
+                return cached[1]
+            self.stats['misses'] += 1
+
+    def fetch(self, post):
+        start = time.perf_counter()
+        # Post.get_replies maps silent(Post) over the replies, so replies that
+        # could not be loaded come back as None
+        replies = [reply for reply in post.get_replies() if reply is not None]
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.stats['rpc_seconds'] += elapsed
+            self._cache.pop(post.identifier, None)
+            self._cache[post.identifier] = (time.time(), replies)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return replies
+
+    def get_replies(self, post):
+        replies = self.get_cached(post)
+        if replies is None:
+            replies = self.fetch(post)
+        return replies
+
+    def get_replies_many(self, posts):
+        replies = {}
+        missing = []
+        for post in posts:
+            cached = self.get_cached(post)
+            if cached is None:
+                missing.append(post)
+            else:
+                replies[post.identifier] = cached
+        if missing:
+            with ThreadPoolExecutor(min(self.workers, len(missing))) as executor:
+                for post, post_replies in zip(missing, executor.map(self.fetch, missing)):
+                    replies[post.identifier] = post_replies
+        return replies
+
+    def invalidate(self, post):
+        with self._lock:
+            self._cache.pop(post.identifier, None)
+
+    def format_stats(self):
+        return '{hits} hits, {misses} misses, {rpc_seconds:.1f}s in rpc'.format(**self.stats)
+
+
+class LoadShedder(object):
+    """
+    Degrades the bot in stages while the stream lags behind the chain.
+
+    Lag is the wall clock minus the timestamp of the block being streamed.
+    Each threshold passed turns on one more stage of SHED_STAGES: skip the
+    is_post_spam reply lookups, score a bounded sample of sentences, then
+    only look at PRIORITY_CATEGORIES. A stage is only left once lag is back
+    under recover_ratio of its threshold, so the bot does not flap around a
+    threshold. Listeners are called with the new level on every change.
+
+    """
+    def __init__(self, thresholds=SHEDDING_THRESHOLDS, recover_ratio=SHEDDING_RECOVER_RATIO,
+                 enabled=SHEDDING_ENABLED):
+        self.thresholds = sorted(thresholds)[:len(SHED_STAGES) - 1]
+        self.recover_ratio = recover_ratio
+        self.enabled = enabled
+        self.level = 0
+        self.lag = 0.0
+        self.listeners = []
+        METRICS.set('kettle_shed_level', 0)
+
+    @property
+    def skips_spam_check(self):
+        return self.level >= 1
+
+    @property
+    def samples_sentences(self):
+        return self.level >= 2
+
+    @property
+    def priority_only(self):
+        return self.level >= 3
+
+    def update(self, lag):
+        self.lag = lag
+        METRICS.set('kettle_stream_lag_seconds', lag)
+        if not self.enabled:
+            return self.level
+        level = self.level
+        while level < len(self.thresholds) and lag >= self.thresholds[level]:
+            level += 1
+        while level > 0 and lag < self.thresholds[level - 1] * self.recover_ratio:
+            level -= 1
+        if level != self.level:
+            self.set_level(level)
+        return self.level
+
+    def set_level(self, level):
+        previous, self.level = self.level, level
+        METRICS.inc(
+            'kettle_shed_transitions_total',
+            from_stage=SHED_STAGES[previous], to_stage=SHED_STAGES[level],
+        )
+        METRICS.set('kettle_shed_level', level)
+        print('stream lag {:.0f}s, shedding {} -> {}'.format(
+            self.lag, SHED_STAGES[previous], SHED_STAGES[level]
+        ))
+        for listener in self.listeners:
+            listener(level)
+
+
 class SteemClient(object):
-    def __init__(self, posting_key=POSTING_KEY, account=ACCOUNT):
+    def __init__(self, posting_key=POSTING_KEY, account=ACCOUNT, steem=None):
         self.account = account
-        self.steem = Steem(keys=[posting_key])
+        if steem is None:
+            steem = Steem(keys=[posting_key])
+            # reply Posts are built on the shared instance, share ours so
+            # their lookups are timed as well
+            set_shared_steemd_instance(instrument_steemd(steem.steemd))
+        self.steem = steem
+        self.head_block = None
+        self.head_block_checked_at = 0
+        self.load_shedder = LoadShedder()
+        self.language_gate = LanguageGate()
+        self.reply_fetcher = ReplyFetcher()
+        self.outbound = None
+        self.operation_types = ['comment']
+        self.operation_handlers = []
+        self.fresh_post_filter = PostFilterChain(
+            [
+                ('category', self.is_allowed_category),
+                ('priority', self.is_priority_category),
+                ('allow_votes', lambda post: post.allow_votes),
+                ('depth', lambda post: not post.is_main_post()),
+                ('age', self.is_within_expiration),
+                ('length', self.is_long_enough),
+                ('language', self.is_english),
+            ],
+            order=FRESH_POST_FILTER_ORDER,
+            on_reject=lambda stage: METRICS.inc('kettle_posts_filtered_total', stage=stage),
+        )
 
-    def stream_fresh_posts(self, expiration_minutes=15):
+    def stream_fresh_posts(self, expiration_minutes=15, checkpoint=None):
         """
         Retrieves posts filtered by the input criteria.
 
@@ -61,51 +938,236 @@ class SteemClient(object):
                 votes should be filtered out
             * expiration_minutes -> integer defining how old a post can be before
                 filtering it out
+            * checkpoint -> optional StreamCheckpoint used to resume the stream
+                after a reset; the caller must finish post.block_num on it once
+                it is done with each yielded post
+
+        Every streamed operation, including the extra operation_types such as
+        votes, is offered to operation_handlers before the post filters run,
+        including the blocks a fresh catch up keeps from the post filters.
 
         """
-        stream = self.steem.stream_comments()
+        stream = self.stream_comment_operations(checkpoint)
+        checked = 0
         while True:
             try:
-                post = next(stream)
-                if self.is_fresh_post(post):
+                operation = next(stream)
+                if not self.handle_operation(operation):
+                    continue
+                if checkpoint is not None and checkpoint.is_stale(operation['block_num']):
+                    checkpoint.skip(operation['block_num'])
+                    continue
+                checked += 1
+                if FILTER_REPORT_EVERY and checked % FILTER_REPORT_EVERY == 0:
+                    print('post filters: {}'.format(self.fresh_post_filter.format_stats()))
+                    print('language gate: {}'.format(self.language_gate.format_stats()))
+                if checkpoint is not None:
+                    checkpoint.start(operation['block_num'])
+                post = self.get_fresh_post(operation)
+                if post is not None:
                     yield post
-            except PostDoesNotExist as exception:
-                print('post does not exist exception... moving on')
-            except LangDetectException as exception:
-                try:
-                    print('language in post not understood, category: {}'.format(post.category))
-                except:
-                    print('couldnt even print out post body')
+                elif checkpoint is not None:
+                    checkpoint.finish(operation['block_num'])
             except Exception as e:
                 print(e)
-                stream = self.steem.stream_comments()
+                stream = self.stream_comment_operations(checkpoint)
 
-    def is_fresh_post(self, post):
-        return (
-            not post.is_main_post()
-            and post.allow_votes
-            and post.time_elapsed() < datetime.timedelta(
-                minutes=EXPIRATION_MINUTES
-            ) and langdetect.detect(post.body) == 'en'
-            and post.category not in EXCLUDE_CATEGORIES
-            and len(post.body.split(' ')) > ARTICLE_LENGTH_LOWER_LIMIT
+    def stream_comment_operations(self, checkpoint=None):
+        blockchain = Blockchain(mode='irreversible', steemd_instance=self.steem)
+        start_block = None
+        if checkpoint is not None:
+            start_block = checkpoint.get_start_block(
+                blockchain.get_current_block_num(), replay_operations=bool(self.operation_handlers)
+            )
+            checkpoint.reset()
+        return blockchain.stream(self.operation_types, start_block=start_block)
+
+    def handle_operation(self, operation):
+        """
+        Passes a streamed operation to the operation handlers and returns
+        True when it is a comment that should go on to the post filters.
+        """
+        METRICS.inc('kettle_operations_total', type=operation['type'])
+        self.update_block_lag(operation)
+        if isinstance(operation.get('timestamp'), datetime.datetime):
+            self.load_shedder.update(
+                (datetime.datetime.utcnow() - operation['timestamp']).total_seconds()
+            )
+        for handler in self.operation_handlers:
+            try:
+                handler(operation)
+            except Exception as e:
+                print('operation handler failed on block {}: {}'.format(
+                    operation.get('block_num'), e
+                ))
+        return operation['type'] == 'comment'
+
+    def get_fresh_post(self, operation):
+        try:
+            post = Post(operation, steemd_instance=self.steem)
+        except PostDoesNotExist as exception:
+            print('post does not exist exception... moving on')
+            return None
+        post.block_num = operation['block_num']
+        if self.is_fresh_post(post):
+            return post
+
+    async def ingest_fresh_posts(self, queue, executor,
+                                 max_in_flight=INGESTION_MAX_IN_FLIGHT,
+                                 checkpoint=None):
+        """
+        Streams comment operations and hydrates them into posts concurrently.
+
+        Operations are read from the stream one at a time, but building the
+        Post for each of them (one get_content round trip) runs on the
+        executor with up to max_in_flight lookups outstanding. Fresh posts are
+        put on the asyncio queue for the scoring and decision stages, which
+        finish post.block_num on the checkpoint once they are done with it.
+        Operation handlers and checkpoint writes run on the executor too, so
+        nothing on the event loop waits on Mongo or steemd.
+
+        """
+        loop = asyncio.get_event_loop()
+        slots = asyncio.Semaphore(max_in_flight)
+        stream = await loop.run_in_executor(
+            executor, self.stream_comment_operations, checkpoint
         )
+        while True:
+            try:
+                operation = await loop.run_in_executor(
+                    executor, self.read_comment_operation, stream, checkpoint
+                )
+            except Exception as e:
+                print(e)
+                operation = None
+            if operation is None:
+                stream = await loop.run_in_executor(
+                    executor, self.stream_comment_operations, checkpoint
+                )
+                continue
+            await slots.acquire()
+            hydration = asyncio.ensure_future(
+                self.hydrate_fresh_post(operation, queue, executor, checkpoint)
+            )
+            hydration.add_done_callback(lambda _: slots.release())
 
+    def read_comment_operation(self, stream, checkpoint=None):
+        """
+        Reads stream up to the next comment for the post filters, passing
+        every operation on the way to the operation handlers, and starts its
+        block on checkpoint. Returns None once the stream ends.
+        """
+        for operation in stream:
+            if not self.handle_operation(operation):
+                continue
+            if checkpoint is not None:
+                if checkpoint.is_stale(operation['block_num']):
+                    checkpoint.skip(operation['block_num'])
+                    continue
+                checkpoint.start(operation['block_num'])
+            return operation
+        return None
 
-    def comment_on_post(self, post, comment):
+    async def hydrate_fresh_post(self, operation, queue, executor, checkpoint=None):
+        loop = asyncio.get_event_loop()
         try:
-            post.reply(author=self.account, body=comment, title=self.account)
+            post = await loop.run_in_executor(executor, self.get_fresh_post, operation)
+        except Exception as e:
+            print(e)
+            post = None
+        if post is None:
+            if checkpoint is not None:
+                await loop.run_in_executor(executor, checkpoint.finish, operation['block_num'])
+            return
+        await queue.put(post)
+
+    def update_block_lag(self, operation):
+        """
+        Sets the block lag gauge for a streamed operation. Head is read every
+        HEAD_BLOCK_REFRESH_SECONDS and extrapolated at one block per
+        SECONDS_PER_BLOCK in between.
+        """
+        now = time.time()
+        if now - self.head_block_checked_at >= HEAD_BLOCK_REFRESH_SECONDS:
+            self.head_block_checked_at = now
+            try:
+                properties = self.steem.get_dynamic_global_properties()
+                self.head_block = properties['head_block_number']
+            except Exception as e:
+                print('could not read head block: {}'.format(e))
+        if self.head_block is None or not operation.get('block_num'):
+            return None
+        head_block = self.head_block + int((now - self.head_block_checked_at) / SECONDS_PER_BLOCK)
+        lag = max(0, head_block - operation['block_num'])
+        METRICS.set('kettle_block_lag_blocks', lag)
+        return lag
+
+    def is_fresh_post(self, post):
+        METRICS.inc('kettle_posts_seen_total')
+        if self.fresh_post_filter(post):
+            METRICS.inc('kettle_posts_fresh_total')
+            return True
+        return False
+
+    def is_allowed_category(self, post):
+        return post.category not in EXCLUDE_CATEGORIES
+
+    def is_priority_category(self, post):
+        return not self.load_shedder.priority_only or post.category in PRIORITY_CATEGORIES
+
+    def is_within_expiration(self, post):
+        return post.time_elapsed() < datetime.timedelta(minutes=EXPIRATION_MINUTES)
+
+    def is_long_enough(self, post):
+        return len(post.body.split(' ')) > ARTICLE_LENGTH_LOWER_LIMIT
+
+    def is_english(self, post):
+        return self.language_gate.is_english(post.body)
+
+    def comment_on_post(self, post, comment, priority=PRIORITY_NORMAL):
+        self.reply_to(post.identifier, comment, priority)
+
+    def reply_to(self, identifier, comment, priority=PRIORITY_NORMAL):
+        if self.outbound is not None:
+            self.outbound.enqueue(
+                'comment', {'identifier': identifier, 'body': comment}, priority
+            )
+            return
+        try:
+            self.send_comment(identifier, comment)
             time.sleep(20)
         except Exception as e:
             print(e)
 
-    def upvote_post(self, post):
+    def upvote_post(self, post, priority=PRIORITY_NORMAL):
+        if self.outbound is not None:
+            self.outbound.enqueue('vote', {'identifier': post.identifier}, priority)
+            return
         try:
-            post.upvote(voter=self.account)
+            self.send_vote(post.identifier)
         except Exception as e:
             print(e)
 
-    def write_post(self, title, body, tags):
+    def write_post(self, title, body, tags, priority=PRIORITY_HIGH):
+        if self.outbound is not None:
+            self.outbound.enqueue(
+                'post', {'title': title, 'body': body, 'tags': tags}, priority
+            )
+            return
+        self.send_post(title, body, tags)
+
+    def send_comment(self, identifier, body):
+        self.steem.commit.post(
+            title=self.account,
+            body=body,
+            author=self.account,
+            reply_identifier=identifier,
+        )
+
+    def send_vote(self, identifier, weight=100):
+        self.steem.commit.vote(identifier, weight, account=self.account)
+
+    def send_post(self, title, body, tags):
         self.steem.commit.post(
             author=self.account,
             body=body,
@@ -114,60 +1176,421 @@ class SteemClient(object):
         )
 
     def is_post_valid(self, post):
-        return not self.is_post_spam(post)
+        return self.load_shedder.skips_spam_check or not self.is_post_spam(post)
 
     def is_post_spam(self, post):
-        replies = post.get_replies()
+        replies = self.reply_fetcher.get_replies(post)
         for reply in replies:
             if reply.author in SPAM_DETECTORS:
                 return True
         return False
 
 
+def get_plan_stages(plan):
+    """
+    Flattens an explain plan into 'STAGE' / 'STAGE(index)' strings, outermost
+    stage first.
+    """
+    stage = plan['stage']
+    if 'indexName' in plan:
+        stage = '{}({})'.format(stage, plan['indexName'])
+    stages = [stage]
+    for child in plan.get('inputStages', [plan['inputStage']] if 'inputStage' in plan else []):
+        stages.extend(get_plan_stages(child))
+    return stages
+
+
+_mongo_clients = {}
+_mongo_clients_lock = threading.Lock()
+
+
+def get_mongo_client(host, port):
+    """
+    Returns the process-wide MongoClient for host and port.
+
+    MongoClient keeps its own connection pool and reconnects by itself, so
+    every MongoSteem in the process shares one client instead of opening a
+    new pool each time an operation fails.
+
+    """
+    with _mongo_clients_lock:
+        client = _mongo_clients.get((host, port))
+        if client is None:
+            client = MongoClient(
+                host,
+                port,
+                maxPoolSize=MONGO_POOL_SIZE,
+                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            )
+            _mongo_clients[(host, port)] = client
+        return client
+
+
+class SeenPostWindow(object):
+    """
+    Remembers the ids of posts stored in the last window_seconds.
+
+    Posts only reach is_post_new while they are younger than
+    EXPIRATION_MINUTES, so when this process is the only one storing posts,
+    a post missing from a complete window cannot be in Mongo either. The
+    window stops being complete when max_entries forces out an id that was
+    still inside it, and becomes complete again once that id would have
+    expired anyway.
+
+    """
+    def __init__(self, window_seconds, max_entries=SEEN_POSTS_MAX_ENTRIES):
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self.incomplete_until = 0
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, post_id):
+        now = time.time()
+        with self._lock:
+            self._seen.pop(post_id, None)
+            self._seen[post_id] = now
+            self.expire(now)
+            while len(self._seen) > self.max_entries:
+                _, seen_at = self._seen.popitem(last=False)
+                self.incomplete_until = max(
+                    self.incomplete_until, seen_at + self.window_seconds
+                )
+
+    def expire(self, now):
+        while self._seen:
+            post_id, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.window_seconds:
+                break
+            del self._seen[post_id]
+
+    def __contains__(self, post_id):
+        return post_id in self._seen
+
+    def __len__(self):
+        return len(self._seen)
+
+    @property
+    def is_complete(self):
+        return time.time() >= self.incomplete_until
+
+
+class PostRecord(object):
+    """
+    Lightweight view of a stored post document.
+
+    The common identity fields are attributes, anything else in the fetched
+    document is available by key. get_post builds the full steem Post, with
+    its get_content call, only on the first request.
+
+    """
+    __slots__ = ('identifier', 'author', 'permlink', 'url', 'created', 'data', '_post')
+
+    def __init__(self, post_data):
+        self.data = post_data
+        self.identifier = post_data.get('identifier')
+        self.author = post_data.get('author')
+        self.permlink = post_data.get('permlink')
+        self.url = post_data.get('url')
+        self.created = post_data.get('created')
+        self._post = None
+        if self.identifier is None and self.author and self.permlink:
+            self.identifier = '{}/{}'.format(self.author, self.permlink)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __repr__(self):
+        return '<PostRecord-{}>'.format(self.identifier)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def get_post(self, steemd_instance=None):
+        if self._post is None:
+            self._post = Post(self.identifier, steemd_instance=steemd_instance)
+        return self._post
+
+
 class MongoSteem(object):
 
-    def __init__(self, host='kettle_db_1', port=27017, db_name='steem'):
+    def __init__(self, host='kettle_db_1', port=27017, db_name='steem',
+                 write_buffer_size=WRITE_BUFFER_SIZE,
+                 write_buffer_seconds=WRITE_BUFFER_SECONDS,
+                 ensure_indexes=MONGO_ENSURE_INDEXES,
+                 unsubscribed_refresh_seconds=UNSUBSCRIBED_REFRESH_SECONDS,
+                 compact=STORAGE_COMPACT, body_storage=STORAGE_BODY,
+                 single_writer=SEEN_POSTS_SINGLE_WRITER):
         self.host = host
         self.port = port
         self.db_name = db_name
+        self.compact = compact
+        self.body_storage = body_storage
+        self.write_buffer_size = write_buffer_size
+        self.write_buffer_seconds = write_buffer_seconds
+        self._write_lock = threading.Lock()
+        self._pending_inserts = []
+        self._pending_updates = []
+        self._pending_ids = set()
+        self._flushed_at = time.time()
+        self.write_stats = {
+            'flushes': 0,
+            'writes': 0,
+            'seconds': 0.0,
+            'last_batch_size': 0,
+            'last_seconds': 0.0,
+        }
+        self.unsubscribed_refresh_seconds = unsubscribed_refresh_seconds
+        self._unsubscribed_lock = threading.Lock()
+        self.seen_posts = SeenPostWindow(
+            (EXPIRATION_MINUTES + SEEN_POSTS_MARGIN_MINUTES) * 60
+        )
+        self.single_writer = single_writer
+        self.dedup_stats = {'seen': 0, 'new': 0, 'mongo_checks': 0}
         self.init_collections()
+        if ensure_indexes:
+            self.ensure_indexes()
+        self.load_unsubscribed_users()
+        self.load_seen_posts()
 
     def init_collections(self):
-        mongo_client = MongoClient(self.host, self.port)
+        mongo_client = get_mongo_client(self.host, self.port)
         db = getattr(mongo_client, self.db_name)
         self.posts = db.posts
         self.users = db.users
+        self.state = db.state
+        self.outbound = db.outbound
+
+    def ensure_indexes(self):
+        for collection_name, keys, options in MONGO_INDEXES:
+            collection = getattr(self, collection_name)
+            try:
+                self.retry(collection.create_index, keys, **options)
+            except OperationFailure as e:
+                print('could not create index {} on {}: {}'.format(
+                    options['name'], collection_name, e
+                ))
+        for collection_name, name in OBSOLETE_MONGO_INDEXES:
+            collection = getattr(self, collection_name)
+            if name in self.retry(collection.index_information):
+                self.retry(collection.drop_index, name)
+                print('dropped unused index {} on {}'.format(name, collection_name))
+
+    def get_hot_queries(self):
+        """
+        Returns (name, collection, query) for the queries run for every post
+        and for the daily roundup, with placeholder values.
+        """
+        return [
+            ('is_post_new', self.posts, {'id': 0}),
+            ('update_post', self.posts, {'identifier': ''}),
+            ('get_positive_posts', self.posts, self.get_positive_posts_query()),
+            ('load_unsubscribed_users', self.users, {'unsubscribed': True}),
+        ]
 
-    def get_post_data_for_storage(self, post):
+    def explain_hot_queries(self):
+        explanations = collections.OrderedDict()
+        for name, collection, query in self.get_hot_queries():
+            explanation = collection.find(query).explain()
+            stats = explanation.get('executionStats', {})
+            explanations[name] = {
+                'stages': get_plan_stages(explanation['queryPlanner']['winningPlan']),
+                'keys_examined': stats.get('totalKeysExamined'),
+                'docs_examined': stats.get('totalDocsExamined'),
+                'returned': stats.get('nReturned'),
+                'millis': stats.get('executionTimeMillis'),
+            }
+        return explanations
+
+    def get_index_stats(self):
+        index_stats = collections.OrderedDict()
+        for collection in (self.posts, self.users):
+            for stats in collection.aggregate([{'$indexStats': {}}]):
+                index_stats['{}.{}'.format(collection.name, stats['name'])] = {
+                    'ops': stats['accesses']['ops'],
+                    'since': stats['accesses']['since'],
+                }
+        return index_stats
+
+    def retry(self, operation, *args, **kwargs):
+        """
+        Runs a Mongo operation, retrying connection failures with backoff.
+
+        Waits grow exponentially from MONGO_RETRY_BACKOFF seconds with full
+        jitter. After MONGO_RETRIES retries the error is raised to the caller.
+        Only idempotent operations should be passed in.
+
+        """
+        name = getattr(operation, '__name__', 'call')
+        if name == '<lambda>':
+            # the lambdas passed in here wrap finds that are read to a list
+            name = 'find'
+        attempt = 0
+        while True:
+            try:
+                with METRICS.timer('kettle_mongo_seconds', operation=name):
+                    return operation(*args, **kwargs)
+            except ConnectionFailure as e:
+                METRICS.inc('kettle_mongo_errors_total', operation=name)
+                if attempt >= MONGO_RETRIES:
+                    raise
+                delay = random.uniform(0, MONGO_RETRY_BACKOFF * 2 ** attempt)
+                print('mongo operation failed ({}), retrying in {:.2f}s'.format(e, delay))
+                time.sleep(delay)
+                attempt += 1
+
+    def get_post_data_for_storage(self, post, refresh=True):
+        """
+        Exports a post for storage. With refresh False the post is exported
+        as it was last loaded, without another get_content call.
+        """
         try:
-            export = post.export()
+            if refresh:
+                export = post.export()
+            else:
+                export = {
+                    key: dict(value) if isinstance(value, Amount) else value
+                    for key, value in post.items()
+                }
         except Exception as e:
             print(e)
 
         export['tags'] = list(export['tags'])
+        if self.compact:
+            export = {key: value for key, value in export.items() if key in STORED_POST_FIELDS}
         return export
 
     def store_post(self, post, additional_data=None):
         post_data = self.get_post_data_for_storage(post)
         if additional_data:
             post_data.update(additional_data)
+        self.store_post_data(post_data)
+
+    def store_post_data(self, post_data):
+        if self.compact:
+            post_data = compact_post_data(dict(post_data), self.body_storage)
+        with self._write_lock:
+            self._pending_inserts.append(post_data)
+            self._pending_ids.add(post_data['id'])
+        self.seen_posts.add(post_data['id'])
+        self.maybe_flush_writes()
+
+    def maybe_flush_writes(self):
+        pending = len(self._pending_inserts) + len(self._pending_updates)
+        if pending and (
+            pending >= self.write_buffer_size
+            or time.time() - self._flushed_at >= self.write_buffer_seconds
+        ):
+            self.flush_writes()
+
+    def flush_writes(self):
+        """
+        Writes the buffered inserts and updates in at most two round trips.
+
+        Inserts go out first as an unordered insert_many so that updates for
+        posts stored in the same batch find their document. Posts that are
+        already stored are skipped. On a connection failure the batch is put
+        back in the buffer for the next flush and the error is raised once
+        the retries run out.
+
+        """
+        with self._write_lock:
+            inserts, self._pending_inserts = self._pending_inserts, []
+            updates, self._pending_updates = self._pending_updates, []
+            self._flushed_at = time.time()
+        if not inserts and not updates:
+            return
+        batch_size = len(inserts) + len(updates)
+        start = time.perf_counter()
         try:
-            self.posts.insert_one(post_data)
-        except:
-            print('failed to store post, reinitting db and trying again')
-            self.init_collections()
-            self.store_post(post, additional_data)
+            if inserts:
+                self.retry(self.write_batch, self.posts.insert_many, inserts)
+                inserts = []
+            if updates:
+                self.retry(self.write_batch, self.posts.bulk_write, updates)
+        except ConnectionFailure:
+            print('failed to flush {} writes, keeping them buffered'.format(
+                len(inserts) + len(updates)
+            ))
+            with self._write_lock:
+                self._pending_inserts = inserts + self._pending_inserts
+                self._pending_updates = updates + self._pending_updates
+            raise
+        finally:
+            with self._write_lock:
+                self._pending_ids = set(
+                    post_data['id'] for post_data in self._pending_inserts
+                )
+        self.record_flush(time.perf_counter() - start, batch_size)
+
+    def write_batch(self, write, batch):
+        try:
+            write(batch, ordered=False)
+        except BulkWriteError as e:
+            errors = [
+                error for error in e.details.get('writeErrors', [])
+                if error.get('code') != DUPLICATE_KEY_ERROR
+            ]
+            if errors:
+                print('{} of {} writes failed: {}'.format(
+                    len(errors), len(batch), errors[0].get('errmsg')
+                ))
+
+    def record_flush(self, seconds, batch_size):
+        self.write_stats['flushes'] += 1
+        self.write_stats['writes'] += batch_size
+        self.write_stats['seconds'] += seconds
+        self.write_stats['last_batch_size'] = batch_size
+        self.write_stats['last_seconds'] = seconds
+        print('flushed {} writes to mongo in {:.1f}ms'.format(batch_size, seconds * 1000))
+
+    def close(self):
+        self.flush_writes()
 
-    def stream_posts_from_mongo(self, query=None, limit=None, raw=False):
+    def stream_posts_from_mongo(self, query=None, limit=None, raw=False, records=False,
+                                projection=None, batch_size=None, sort=None, hint=None):
+        """
+        Streams stored posts matching query.
+
+        * Args
+            * query -> Mongo filter, defaults to every post
+            * limit -> maximum number of posts to return
+            * raw -> yield the stored documents, expanded to the plain schema
+            * records -> yield PostRecord views that only build a Post, and
+                hit the chain, when asked to
+            * projection -> fields to fetch, applies to raw and records
+            * batch_size -> documents per round trip to Mongo
+            * sort -> list of (key, direction) pairs
+            * hint -> index name or key list for the query planner
+
+        Without raw or records every document becomes a full Post, which
+        costs a get_content call each.
+
+        """
         if query is None:
             query = {}
-        post_query = self.posts.find(query)
+        if not (raw or records):
+            projection = None
+        post_query = self.posts.find(query, projection)
+        if sort:
+            post_query = post_query.sort(sort)
+        if hint:
+            post_query = post_query.hint(hint)
+        if batch_size:
+            post_query = post_query.batch_size(batch_size)
         if limit:
             post_query = post_query.limit(limit)
         try:
             for post_data in post_query:
                 if raw:
-                    yield post_data
+                    yield expand_post_data(post_data)
+                elif records:
+                    yield PostRecord(expand_post_data(post_data))
                 else:
                     yield Post(post_data)
 
@@ -175,90 +1598,446 @@ class MongoSteem(object):
             print(e)
 
     def update_post(self, post, **kwargs):
-        post.refresh()
+        # Post.export refreshes the post from the chain itself
         post_data = self.get_post_data_for_storage(post)
         post_data.update(kwargs)
-        try:
-            self.posts.update_one(
-                {'identifier': post.identifier},
-                {'$set': post_data},
-            )
-        except:
-            print('failed to update post, reinitting db and trying again')
-            self.init_collections()
-            self.update_post(post, **kwargs)
+        update = {'$set': post_data}
+        if self.compact:
+            compact_post_data(post_data, self.body_storage)
+            if 'body' not in post_data:
+                update['$unset'] = {'body': ''}
+        with self._write_lock:
+            self._pending_updates.append(UpdateOne({'identifier': post.identifier}, update))
+        self.maybe_flush_writes()
+
+    def update_posts(self, query=None, workers=REFRESH_WORKERS, batch_size=REFRESH_BATCH_SIZE,
+                     report_every=REFRESH_REPORT_EVERY):
+        """
+        Refreshes stored posts from the chain.
+
+        Posts are loaded batch_size at a time, workers at once, with a single
+        get_content call each. Every fresh export is diffed against the
+        stored document and only the fields that changed are written, in one
+        unordered bulk_write per batch. Returns the totals that are also
+        printed every report_every posts.
 
-    def update_posts(self, query=None):
+        """
         if not query:
             query = {}
-        for post in self.stream_posts_from_mongo(query=query):
-            self.update_post(post)
+        totals = {'posts': 0, 'changed': 0, 'failed': 0}
+        started = time.time()
+        reported = 0
+        cursor = self.posts.find(query).batch_size(batch_size)
+        with ThreadPoolExecutor(workers) as executor:
+            while True:
+                batch = list(itertools.islice(cursor, batch_size))
+                if not batch:
+                    break
+                requests = []
+                for post_data, changes in zip(batch, executor.map(self.get_post_changes, batch)):
+                    totals['posts'] += 1
+                    if changes is None:
+                        totals['failed'] += 1
+                    elif changes:
+                        totals['changed'] += 1
+                        requests.append(UpdateOne({'_id': post_data['_id']}, {'$set': changes}))
+                if requests:
+                    self.retry(self.posts.bulk_write, requests, ordered=False)
+                if report_every and totals['posts'] - reported >= report_every:
+                    reported = totals['posts']
+                    print(self.format_refresh_progress(totals, started))
+        print(self.format_refresh_progress(totals, started))
+        return totals
 
-    def is_post_new(self, post):
+    def get_post_changes(self, post_data):
+        """
+        Loads the current version of a stored post and returns the fields
+        that differ from post_data, or None when it could not be loaded.
+        """
         try:
-            return not bool(self.posts.find_one({'id': post.id}, {'_id': 1}))
-        except:
-            print('failed to check if post is new, reinitting db and trying again')
-            self.init_collections()
-            return self.is_post_new(post)
+            post = Post(post_data['identifier'])
+            fresh_data = self.get_post_data_for_storage(post, refresh=False)
+        except Exception as e:
+            print('could not refresh {}: {}'.format(post_data.get('identifier'), e))
+            return None
+        if self.compact:
+            compact_post_data(fresh_data, self.body_storage)
+        changes = {}
+        for key, value in fresh_data.items():
+            stored = post_data.get(key)
+            if key == 'tags' and stored is not None and set(stored) == set(value):
+                continue
+            if stored != value:
+                changes[key] = value
+        return changes
+
+    def format_refresh_progress(self, totals, started):
+        elapsed = max(time.time() - started, 1e-6)
+        return (
+            'refreshed {posts} posts ({changed} changed, {failed} failed), '
+            '{rate:.1f} posts/s'.format(rate=totals['posts'] / elapsed, **totals)
+        )
+
+    def compact_stored_posts(self, batch_size=500, body_storage=None):
+        """
+        Rewrites stored posts into the compact schema, batch_size at a time.
+
+        Export fields outside STORED_POST_FIELDS are unset. Documents are
+        walked in _id order and each update only matches a document that is
+        not compact yet, so an interrupted run can simply be started again.
+        Returns the number of documents and BSON bytes before and after.
+
+        """
+        body_storage = body_storage or self.body_storage
+        keep = STORED_POST_FIELDS | BOT_POST_FIELDS
+        totals = {'posts': 0, 'bytes_before': 0, 'bytes_after': 0}
+        last_id = None
+        while True:
+            query = {'storage_version': {'$ne': COMPACT_STORAGE_VERSION}}
+            if last_id is not None:
+                query['_id'] = {'$gt': last_id}
+            batch = self.retry(
+                lambda: list(self.posts.find(query).sort('_id', ASCENDING).limit(batch_size))
+            )
+            if not batch:
+                return totals
+            requests = []
+            for post_data in batch:
+                compact = compact_post_data(
+                    {key: value for key, value in post_data.items() if key in keep},
+                    body_storage,
+                )
+                unset = {key: '' for key in post_data if key not in compact}
+                update = {'$set': {key: value for key, value in compact.items() if key != '_id'}}
+                if unset:
+                    update['$unset'] = unset
+                requests.append(UpdateOne(
+                    {'_id': post_data['_id'], 'storage_version': {'$ne': COMPACT_STORAGE_VERSION}},
+                    update,
+                ))
+                totals['posts'] += 1
+                totals['bytes_before'] += len(BSON.encode(post_data))
+                totals['bytes_after'] += len(BSON.encode(compact))
+            self.retry(self.posts.bulk_write, requests, ordered=False)
+            last_id = batch[-1]['_id']
+            print('compacted {posts} posts, {bytes_before} -> {bytes_after} bytes'.format(**totals))
+
+    def rescore_stored_posts(self, sentiment_analyzer, query=None, batch_size=500):
+        """
+        Rescores stored posts from their stored bodies, batch_size at a time,
+        with PostSentimentAnalyzer.score_posts.
+
+        overall_polarity and the outlier flags are rewritten so posts scored
+        before a threshold or lexicon change are judged like new ones; the
+        per-sentence polarities are left as they were. Every sentence is
+        scored, so the sentence_sample marker of posts scored while shedding
+        load is removed. Posts stored without a body are skipped. Returns the
+        number of posts rescored and of posts whose is_pos_outlier flag
+        changed.
+
+        """
+        totals = {'posts': 0, 'skipped': 0, 'flipped': 0}
+        projection = {
+            'identifier': 1, 'body': 1, 'body_z': 1, 'storage_version': 1, 'is_pos_outlier': 1,
+        }
+        stored_posts = self.stream_posts_from_mongo(
+            query, raw=True, projection=projection, batch_size=batch_size
+        )
+        while True:
+            batch = list(itertools.islice(stored_posts, batch_size))
+            if not batch:
+                return totals
+            scored = [post_data for post_data in batch if post_data.get('body')]
+            totals['skipped'] += len(batch) - len(scored)
+            results = sentiment_analyzer.score_posts(
+                StoredPostBody(post_data['identifier'], post_data['body']) for post_data in scored
+            )
+            requests = []
+            for post_data, result in zip(scored, results):
+                if not result['sentences']:
+                    totals['skipped'] += 1
+                    continue
+                is_pos_outlier = bool(result['is_pos_outlier'])
+                totals['posts'] += 1
+                totals['flipped'] += int(is_pos_outlier != post_data.get('is_pos_outlier'))
+                requests.append(UpdateOne({'_id': post_data['_id']}, {
+                    '$set': {
+                        'overall_polarity': {key: float(result[key]) for key in POLARITY_KEYS},
+                        'is_pos_outlier': is_pos_outlier,
+                        'is_neg_outlier': bool(result['is_neg_outlier']),
+                    },
+                    '$unset': {'sentence_sample': ''},
+                }))
+            if requests:
+                self.retry(self.posts.bulk_write, requests, ordered=False)
+            print('rescored {posts} posts ({flipped} changed positive outlier, '
+                  '{skipped} skipped)'.format(**totals))
+
+    def load_seen_posts(self):
+        created_after = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=self.seen_posts.window_seconds
+        )
+        recent_posts = self.retry(
+            lambda: list(self.posts.find({'created': {'$gte': created_after}}, {'id': 1}))
+        )
+        for post_data in recent_posts:
+            self.seen_posts.add(post_data['id'])
+
+    def is_post_new(self, post):
+        """
+        Returns False for posts this process has stored recently without a
+        round trip. Any other post is looked up in Mongo, where other bot
+        instances and the celery storage workers store posts too, unless
+        single_writer says this process is the only writer and the local
+        window is complete for the post's age.
+        """
+        if post.id in self._pending_ids or post.id in self.seen_posts:
+            self.dedup_stats['seen'] += 1
+            return False
+        if (
+            self.single_writer
+            and self.seen_posts.is_complete
+            and post.time_elapsed().total_seconds() < self.seen_posts.window_seconds
+        ):
+            self.dedup_stats['new'] += 1
+            return True
+        self.dedup_stats['mongo_checks'] += 1
+        return not bool(self.retry(self.posts.find_one, {'id': post.id}, {'_id': 1}))
 
     def unsubscribe_user(self, user):
-        self.users.update_one(
+        self.retry(
+            self.users.update_one,
             {'user': user},
             {'$set': {'user': user, 'unsubscribed': True}},
             upsert=True,
         )
+        with self._unsubscribed_lock:
+            self.unsubscribed_users.add(user)
+
+    def load_unsubscribed_users(self):
+        """
+        Reloads the in-process set of unsubscribed users from Mongo.
+
+        The set is tiny and only grows through unsubscribe_user, which updates
+        it right away. The periodic reload in is_user_unsubscribed picks up
+        unsubscribes made by other instances of the bot.
+
+        """
+        with self._unsubscribed_lock:
+            self.unsubscribed_users = set(
+                user_data['user'] for user_data in self.retry(
+                    lambda: list(self.users.find({'unsubscribed': True}, {'user': 1, '_id': 0}))
+                )
+            )
+            self.unsubscribed_loaded_at = time.time()
 
     def get_positive_posts(self):
-        return self.posts.find({
+        return self.posts.find(self.get_positive_posts_query(), POST_RECORD_PROJECTION)
+
+    def get_positive_posts_query(self):
+        return {
             'created': {'$gt': datetime.datetime.now() - datetime.timedelta(hours=48)},
             'is_pos_outlier': True,
             'is_in_positive_article_post': {'$exists': False},
+        }
+
+    def get_sampled_posts_query(self):
+        """
+        Matches the posts a roundup could pick that were scored from a
+        sentence sample while shedding load.
+        """
+        return {
+            'created': {'$gt': datetime.datetime.now() - datetime.timedelta(hours=48)},
+            'sentence_sample': {'$exists': True},
+            'is_in_positive_article_post': {'$exists': False},
+        }
+
+    def get_curated_posts(self):
+        """
+        Returns roundup candidates the curators have already confirmed, using
+        the tallies kept by CurationTracker.
+        """
+        query = self.get_positive_posts_query()
+        query.update({
+            'curation.stopped': {'$ne': True},
+            '$or': [
+                {'curation.net_votes': {'$gt': 0}},
+                {'curation.score': {'$gt': 0}},
+            ],
         })
+        projection = {'identifier': 1, 'author': 1, 'url': 1, 'curation.curators': 1}
+        return self.retry(lambda: list(self.posts.find(query, projection)))
+
+    def mark_in_positive_article_post(self, identifiers):
+        self.retry(
+            self.posts.update_many,
+            {'identifier': {'$in': list(identifiers)}},
+            {'$set': {'is_in_positive_article_post': True}},
+        )
 
     def is_post_valid(self, post):
-        return self.is_post_new(post) and self.is_user_unsubscribed(post.author)
+        return self.is_post_new(post) and not self.is_user_unsubscribed(post.author)
 
     def is_user_unsubscribed(self, user):
-        return bool(
-            self.users.find_one(
-                {
-                    'unsubscribed': True,
-                    'user': user
-                },
-                {'_id': 1}
-            )
-        )
+        if time.time() - self.unsubscribed_loaded_at >= self.unsubscribed_refresh_seconds:
+            self.load_unsubscribed_users()
+        return user in self.unsubscribed_users
+
+
+# the two fields of a post PostSentimentAnalyzer.score_posts reads
+StoredPostBody = collections.namedtuple('StoredPostBody', ['identifier', 'body'])
+SentimentResult = collections.namedtuple('SentimentResult', [
+    'polarities',
+    'normalized_polarities',
+    'overall_polarity',
+    'avg_normalized_polarity',
+    'is_pos_outlier',
+    'is_neg_outlier',
+    # sentences scored when only a sample was, None for a full score
+    'sentence_sample',
+])
 
 
 class PostSentimentAnalyzer(object):
-    def __init__(self):
+    def __init__(self, cache_size=32):
         self.sid = SentimentIntensityAnalyzer()
         self.negative_threshold = NEGATIVE_THRESHOLD
         self.positive_threshold = POSITIVE_THRESHOLD
+        self.cache_size = cache_size
+        self._results = collections.OrderedDict()
+        self._results_lock = threading.Lock()
+        # set while shedding load, see LoadShedder
+        self.sentence_limit = None
 
     def get_tokens(self, post):
-        return tokenize.sent_tokenize(post.body)
+        return self.tokenize_body(post.body)
 
-    def get_polarities(self, post):
-        polarities = []
-        for token in self.get_tokens(post):
-            polarities.append(self.sid.polarity_scores(token))
-        return polarities
+    def tokenize_body(self, body):
+        with METRICS.timer('kettle_stage_seconds', stage='tokenize'):
+            return tokenize.sent_tokenize(body)
 
-    def get_normalized_polarities(self, post):
-        return [pol['pos'] - pol['neg'] for pol in self.get_polarities(post)]
+    def get_sentiment(self, post):
+        """
+        Scores the post once and returns its SentimentResult.
 
-    def get_overall_polarity(self, post):
+        Results are kept in a small LRU keyed by identifier and body, so every
+        public method (and to_mongo) reuses a single tokenize + VADER pass for
+        a given revision of a post. A result scored from a sentence sample is
+        only reused while sentences are still being sampled; once the
+        analyzer is back at full fidelity the post is scored again.
+
+        """
+        key = (post.identifier, post.body)
+        with self._results_lock:
+            result = self._results.get(key)
+            if result is not None and (
+                result.sentence_sample is None or self.sentence_limit is not None
+            ):
+                self._results.move_to_end(key)
+                return result
+        result = self.score_body(post.body)
+        METRICS.inc('kettle_posts_scored_total')
+        return self.cache_result(post, result)
+
+    def cache_result(self, post, result):
+        with self._results_lock:
+            self._results[(post.identifier, post.body)] = result
+            if len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+        return result
+
+    def score_body(self, body):
+        tokens = self.tokenize_body(body)
+        sampled_tokens = sample_sentences(tokens, self.sentence_limit)
+        if len(sampled_tokens) < len(tokens):
+            return self.score(sampled_tokens, sentence_sample=len(sampled_tokens))
+        return self.score(tokens)
+
+    def score(self, tokens, sentence_sample=None):
+        with METRICS.timer('kettle_stage_seconds', stage='vader'):
+            polarities = tuple(self.sid.polarity_scores(token) for token in tokens)
+        normalized_polarities = tuple(
+            pol['pos'] - pol['neg'] for pol in polarities
+        )
         overall_polarity = {}
-        polarities = self.get_polarities(post)
-        for key in ['pos', 'neg', 'neu', 'compound']:
-            average = round(
+        for key in POLARITY_KEYS:
+            overall_polarity[key] = round(
                 sum([pol[key] for pol in polarities]) / len(polarities),
                 3
             )
-            overall_polarity[key] = average
-        return overall_polarity
+        avg_normalized_polarity = round(
+            sum(normalized_polarities) / len(normalized_polarities),
+            2
+        )
+        return SentimentResult(
+            polarities=polarities,
+            normalized_polarities=normalized_polarities,
+            overall_polarity=overall_polarity,
+            avg_normalized_polarity=avg_normalized_polarity,
+            is_pos_outlier=avg_normalized_polarity >= self.positive_threshold,
+            is_neg_outlier=avg_normalized_polarity <= self.negative_threshold,
+            sentence_sample=sentence_sample,
+        )
+
+    def score_posts(self, posts):
+        """
+        Scores a batch of posts in one pass and returns a SCORE_DTYPE array.
+
+        Every sentence of the batch is scored into a single (n, 4) matrix and
+        the per-post averages are taken with segment reductions over it, so
+        backfills and rescoring avoid the per-post bookkeeping of
+        get_sentiment. Posts without sentences get NaN averages and are never
+        flagged as outliers. MongoSteem.rescore_stored_posts runs stored
+        posts through it.
+
+        """
+        posts = list(posts)
+        token_lists = [self.get_tokens(post) for post in posts]
+        counts = numpy.array([len(tokens) for tokens in token_lists], dtype=numpy.intp)
+        with METRICS.timer('kettle_stage_seconds', stage='vader'):
+            scores = numpy.array(
+                [
+                    [pol[key] for key in POLARITY_KEYS]
+                    for pol in map(
+                        self.sid.polarity_scores,
+                        [token for tokens in token_lists for token in tokens],
+                    )
+                ],
+                dtype=numpy.float64,
+            ).reshape(-1, len(POLARITY_KEYS))
+        METRICS.inc('kettle_posts_scored_total', len(posts))
+
+        sums = numpy.zeros((len(posts), len(POLARITY_KEYS)))
+        nonempty = counts > 0
+        if nonempty.any():
+            offsets = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+            sums[nonempty] = numpy.add.reduceat(scores, offsets[nonempty], axis=0)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            averages = sums / counts[:, None]
+            avg_normalized = (sums[:, 0] - sums[:, 1]) / counts
+
+        results = numpy.zeros(len(posts), dtype=SCORE_DTYPE)
+        results['identifier'] = [post.identifier for post in posts]
+        results['sentences'] = counts
+        for index, key in enumerate(POLARITY_KEYS):
+            results[key] = numpy.round(averages[:, index], 3)
+        results['avg_normalized_polarity'] = numpy.round(avg_normalized, 2)
+        results['is_pos_outlier'] = nonempty & (
+            results['avg_normalized_polarity'] >= self.positive_threshold
+        )
+        results['is_neg_outlier'] = nonempty & (
+            results['avg_normalized_polarity'] <= self.negative_threshold
+        )
+        return results
+
+    def get_polarities(self, post):
+        return [dict(pol) for pol in self.get_sentiment(post).polarities]
+
+    def get_normalized_polarities(self, post):
+        return list(self.get_sentiment(post).normalized_polarities)
+
+    def get_overall_polarity(self, post):
+        return dict(self.get_sentiment(post).overall_polarity)
 
     def get_intro(self, post):
         return (
@@ -296,46 +2075,663 @@ class PostSentimentAnalyzer(object):
         )
 
     def get_avg_normalized_polarity(self, post):
-        normalized_polarities = self.get_normalized_polarities(post)
-        return round(
-            sum(normalized_polarities) / len(normalized_polarities),
-            2
-        )
+        return self.get_sentiment(post).avg_normalized_polarity
 
     def to_mongo(self, post):
-        return {
-            'polarities': self.get_polarities(post),
-            'normalized_polarities': self.get_normalized_polarities(post),
-            'overall_polarity': self.get_overall_polarity(post),
-            'is_pos_outlier': self.is_pos_outlier(post),
-            'is_neg_outlier': self.is_neg_outlier(post),
+        return self.result_to_mongo(self.get_sentiment(post))
+
+    def result_to_mongo(self, result):
+        sentiment = {
+            'polarities': [dict(pol) for pol in result.polarities],
+            'normalized_polarities': list(result.normalized_polarities),
+            'overall_polarity': dict(result.overall_polarity),
+            'is_pos_outlier': result.is_pos_outlier,
+            'is_neg_outlier': result.is_neg_outlier,
         }
+        if result.sentence_sample is not None:
+            sentiment['sentence_sample'] = result.sentence_sample
+        return sentiment
 
     def is_neg_outlier(self, post):
-        return self.get_avg_normalized_polarity(post) <= self.negative_threshold
+        return self.get_sentiment(post).is_neg_outlier
 
     def is_pos_outlier(self, post):
-        return self.get_avg_normalized_polarity(post) >= self.positive_threshold
+        return self.get_sentiment(post).is_pos_outlier
+
+
+_worker_analyzer = None
+
+
+def _init_scoring_worker():
+    global _worker_analyzer
+    _worker_analyzer = PostSentimentAnalyzer()
+    tokenize.sent_tokenize('Loads punkt once.')
+    langdetect.DetectorFactory.seed = LANGUAGE_SEED
+    langdetect.detect('Loads the language profiles once.')
+
+
+def _score_in_worker(job):
+    body, sentence_limit = job
+    _worker_analyzer.sentence_limit = sentence_limit
+    return _worker_analyzer.score_body(body)
+
+
+class ScoringPool(object):
+    """
+    Scores posts on a pool of worker processes.
+
+    Each worker loads VADER, punkt and the langdetect profiles once in its
+    initializer. Only post bodies cross the process boundary; the results are
+    put into the analyzer's cache so the caller keeps using the normal
+    PostSentimentAnalyzer methods on the original post objects. Posts are
+    read and submitted on the calling thread, so the input stream, its RPCs
+    and its checkpoint bookkeeping never run on the pool's own threads.
+
+    * Args
+        * workers -> number of worker processes
+        * ordered -> boolean that designates if posts should come back in the
+            order they were submitted
+        * max_pending -> integer limit of posts that may be in flight before
+            the input stream is paused
+        * poll_seconds -> how often a wait for a result checks for close()
+
+    """
+    def __init__(self, workers=SCORING_WORKERS, ordered=SCORING_ORDERED,
+                 max_pending=SCORING_MAX_PENDING, poll_seconds=0.1):
+        self.workers = workers
+        self.ordered = ordered
+        self.max_pending = max_pending
+        self.poll_seconds = poll_seconds
+        self.pool = multiprocessing.Pool(workers, initializer=_init_scoring_worker)
+        self._closed = threading.Event()
+
+    def score(self, posts, analyzer):
+        """
+        Yields posts once they are scored. Results are collected between
+        reads of posts, and the next post is only read while fewer than
+        max_pending are in flight. Stops without reading further once close()
+        is called.
+        """
+        pending = collections.deque()
+        for post in posts:
+            if self._closed.is_set():
+                return
+            result = self.pool.apply_async(
+                _score_in_worker, ((post.body, analyzer.sentence_limit),)
+            )
+            pending.append((post, result))
+            for scored_post in self.collect(pending, analyzer, self.max_pending - 1):
+                yield scored_post
+        for scored_post in self.collect(pending, analyzer, 0):
+            yield scored_post
+
+    def collect(self, pending, analyzer, max_left):
+        """
+        Yields the pending posts that are done, waiting for results until at
+        most max_left are still in flight.
+        """
+        while pending and not self._closed.is_set():
+            if self.ordered:
+                done = pending[0] if pending[0][1].ready() else None
+            else:
+                done = next((item for item in pending if item[1].ready()), None)
+            if done is None:
+                if len(pending) <= max_left:
+                    return
+                pending[0][1].wait(self.poll_seconds)
+                continue
+            pending.remove(done)
+            post, result = done
+            analyzer.cache_result(post, result.get())
+            # workers count into their own copy of METRICS
+            METRICS.inc('kettle_posts_scored_total')
+            yield post
+
+    def score_one(self, post, analyzer):
+        result = self.pool.apply_async(
+            _score_in_worker, ((post.body, analyzer.sentence_limit),)
+        )
+        while not result.ready():
+            if self._closed.is_set():
+                raise RuntimeError('scoring pool closed')
+            result.wait(self.poll_seconds)
+        sentiment = result.get()
+        METRICS.inc('kettle_posts_scored_total')
+        return analyzer.cache_result(post, sentiment)
+
+    def close(self):
+        # a terminated pool never delivers the results score() may be
+        # waiting on, so let it see the close first
+        self._closed.set()
+        self.pool.terminate()
+        self.pool.join()
+
+
+def get_outbound_id(action, payload):
+    digest = hashlib.sha1(
+        json.dumps(payload, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+    return '{}:{}'.format(action, digest)
+
+
+class TokenBucket(object):
+    """
+    Allows one action every interval seconds on average, with bursts of up
+    to burst actions.
+    """
+    def __init__(self, interval, burst=1):
+        self.interval = interval
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+        self.updated = now
+
+    def is_ready(self):
+        self.refill()
+        return self.tokens >= 1
+
+    def take(self):
+        self.refill()
+        self.tokens -= 1
+
+    def get_wait(self):
+        self.refill()
+        return max(0.0, (1 - self.tokens) * self.interval)
+
+
+class OutboundScheduler(object):
+    """
+    Sends votes, comments and posts from a queue stored in Mongo.
+
+    Actions are written to the outbound collection and sent by a single
+    worker thread, highest priority first, with one token bucket per action
+    type to stay under the chain's per-account limits. Failed sends are
+    retried with exponential backoff up to max_attempts times. An action
+    is keyed by its type and payload, so it is only ever queued once. An
+    action still marked sending on start may or may not have reached the
+    chain; it is marked interrupted rather than sent a second time.
+
+    """
+    def __init__(self, steem_client, mongo_steem, intervals=None,
+                 burst=OUTBOUND_BURST, max_attempts=OUTBOUND_MAX_ATTEMPTS,
+                 retry_backoff=OUTBOUND_RETRY_BACKOFF,
+                 poll_seconds=OUTBOUND_POLL_SECONDS):
+        self.steem_client = steem_client
+        self.mongo_steem = mongo_steem
+        self.buckets = {
+            action: TokenBucket(interval, burst)
+            for action, interval in (intervals or OUTBOUND_INTERVALS).items()
+        }
+        self.senders = {
+            'vote': lambda payload: steem_client.send_vote(payload['identifier']),
+            'comment': lambda payload: steem_client.send_comment(
+                payload['identifier'], payload['body']
+            ),
+            'post': lambda payload: steem_client.send_post(
+                payload['title'], payload['body'], payload['tags']
+            ),
+        }
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.poll_seconds = poll_seconds
+        self.stats = {'enqueued': 0, 'sent': 0, 'retried': 0, 'failed': 0}
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def enqueue(self, action, payload, priority=PRIORITY_NORMAL):
+        now = datetime.datetime.utcnow()
+        try:
+            # the _id makes the insert safe to retry after a lost reply
+            self.mongo_steem.retry(self.mongo_steem.outbound.insert_one, {
+                '_id': get_outbound_id(action, payload),
+                'action': action,
+                'payload': payload,
+                'priority': priority,
+                'status': 'pending',
+                'attempts': 0,
+                'created': now,
+                'not_before': now,
+            })
+        except DuplicateKeyError:
+            print('{} {} is already queued'.format(
+                action, payload.get('identifier', payload.get('title'))
+            ))
+            return
+        self.stats['enqueued'] += 1
+        self._wakeup.set()
+
+    def get_queue_depth(self):
+        outbound = self.mongo_steem.outbound
+        count = getattr(outbound, 'count_documents', None) or outbound.count
+        return count({'status': 'pending'})
+
+    def start(self):
+        interrupted = self.mongo_steem.retry(
+            self.mongo_steem.outbound.update_many,
+            {'status': 'sending'},
+            {'$set': {'status': 'interrupted'}},
+        )
+        if interrupted.modified_count:
+            print('{} outbound actions were interrupted while sending and will not be '
+                  'retried'.format(interrupted.modified_count))
+        self._thread = threading.Thread(target=self.run, name='outbound', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                sent = self.send_next()
+            except Exception as e:
+                print('outbound scheduler error: {}'.format(e))
+                sent = False
+            if not sent:
+                self._wakeup.wait(self.get_idle_wait())
+                self._wakeup.clear()
+
+    def get_idle_wait(self):
+        waits = [bucket.get_wait() for bucket in self.buckets.values() if not bucket.is_ready()]
+        return min([self.poll_seconds] + waits)
+
+    def send_next(self):
+        ready_actions = [action for action, bucket in self.buckets.items() if bucket.is_ready()]
+        if not ready_actions:
+            return False
+        outbound_action = self.mongo_steem.outbound.find_one_and_update(
+            {
+                'status': 'pending',
+                'action': {'$in': ready_actions},
+                'not_before': {'$lte': datetime.datetime.utcnow()},
+            },
+            {'$set': {'status': 'sending'}},
+            sort=[('priority', ASCENDING), ('created', ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if outbound_action is None:
+            return False
+        self.buckets[outbound_action['action']].take()
+        try:
+            self.senders[outbound_action['action']](outbound_action['payload'])
+        except Exception as e:
+            self.handle_failure(outbound_action, e)
+            return True
+        METRICS.inc('kettle_outbound_actions_total', action=outbound_action['action'], result='sent')
+        self.mongo_steem.outbound.update_one(
+            {'_id': outbound_action['_id']},
+            {'$set': {'status': 'done', 'sent': datetime.datetime.utcnow()}},
+        )
+        self.stats['sent'] += 1
+        print('sent {} {} ({} queued)'.format(
+            outbound_action['action'],
+            outbound_action['payload'].get('identifier', outbound_action['payload'].get('title')),
+            self.get_queue_depth(),
+        ))
+        return True
+
+    def handle_failure(self, outbound_action, error):
+        attempts = outbound_action['attempts'] + 1
+        update = {'attempts': attempts, 'error': str(error)}
+        if attempts >= self.max_attempts:
+            update['status'] = 'failed'
+            self.stats['failed'] += 1
+            METRICS.inc('kettle_outbound_actions_total', action=outbound_action['action'], result='failed')
+            print('giving up on {} after {} attempts: {}'.format(
+                outbound_action['action'], attempts, error
+            ))
+        else:
+            update['status'] = 'pending'
+            update['not_before'] = datetime.datetime.utcnow() + datetime.timedelta(
+                seconds=self.retry_backoff * 2 ** (attempts - 1)
+            )
+            self.stats['retried'] += 1
+            METRICS.inc('kettle_outbound_actions_total', action=outbound_action['action'], result='retried')
+        self.mongo_steem.outbound.update_one({'_id': outbound_action['_id']}, {'$set': update})
+
+
+class CurationTracker(object):
+    """
+    Keeps per-post curation tallies up to date from the operation stream.
+
+    The bot's own comments are linked to the post they were left on, and
+    replies and votes on them are tallied into the post's curation
+    sub-document with guarded $inc/$addToSet updates, so replaying a block
+    after a restart does not count anything twice. Replies saying stop are
+    handled as soon as they are seen rather than at roundup time. The
+    stream replays every block since the checkpoint to the tracker, even
+    when the post filters catch up from fresh blocks only.
+
+    Reply classification follows is_post_verified_positive: a reply counts
+    once for yes and/or no, plus one for every net vote it receives.
+
+    """
+    def __init__(self, steem_client, mongo_steem, account=ACCOUNT,
+                 window_hours=CURATION_WINDOW_HOURS):
+        self.steem_client = steem_client
+        self.mongo_steem = mongo_steem
+        self.account = account
+        self.window = datetime.timedelta(hours=window_hours)
+        self.tracked_replies = {}
+        self.pruned_at = time.time()
+        self.stats = collections.Counter()
+        self.load_tracked_replies()
+
+    def load_tracked_replies(self):
+        """
+        Reloads the yes/no replies of recent posts so votes on them keep
+        counting across restarts.
+        """
+        since = datetime.datetime.now() - self.window
+        query = {'created': {'$gt': since}, 'bot_comment': {'$exists': True}}
+        projection = {
+            'identifier': 1, 'created': 1,
+            'curation.yes_replies': 1, 'curation.no_replies': 1,
+        }
+        self.tracked_replies = {}
+        for post_data in self.mongo_steem.retry(
+            lambda: list(self.mongo_steem.posts.find(query, projection))
+        ):
+            curation = post_data.get('curation', {})
+            yes_replies = set(curation.get('yes_replies', []))
+            no_replies = set(curation.get('no_replies', []))
+            for reply_identifier in yes_replies | no_replies:
+                self.tracked_replies[reply_identifier] = (
+                    post_data['identifier'],
+                    get_curation_deltas(
+                        reply_identifier in yes_replies, reply_identifier in no_replies
+                    ),
+                    post_data['created'],
+                )
+
+    def prune_tracked_replies(self):
+        if time.time() - self.pruned_at < 3600:
+            return
+        since = datetime.datetime.now() - self.window
+        self.tracked_replies = {
+            reply_identifier: tracked
+            for reply_identifier, tracked in self.tracked_replies.items()
+            if tracked[2] > since
+        }
+        self.pruned_at = time.time()
+
+    def handle_operation(self, operation):
+        if operation['type'] == 'comment':
+            if operation['author'] == self.account and operation['parent_author']:
+                self.record_bot_comment(operation)
+            elif operation['parent_author'] == self.account:
+                self.record_reply(operation)
+        elif operation['type'] == 'vote':
+            identifier = '{}/{}'.format(operation['author'], operation['permlink'])
+            if operation['author'] == self.account:
+                self.record_bot_comment_vote(identifier, operation)
+            elif identifier in self.tracked_replies:
+                self.record_reply_vote(identifier, operation)
+        self.prune_tracked_replies()
+
+    def record_bot_comment(self, operation):
+        post_identifier = '{}/{}'.format(operation['parent_author'], operation['parent_permlink'])
+        bot_comment = '{}/{}'.format(operation['author'], operation['permlink'])
+        self.mongo_steem.retry(
+            self.mongo_steem.posts.update_one,
+            {'identifier': post_identifier},
+            {'$set': {'bot_comment': bot_comment}},
+        )
+        self.stats['bot_comments'] += 1
+
+    def record_reply(self, operation):
+        bot_comment = '{}/{}'.format(operation['parent_author'], operation['parent_permlink'])
+        reply_identifier = '{}/{}'.format(operation['author'], operation['permlink'])
+        reply_words = get_reply_words(operation['body'])
+        is_yes = 'yes' in reply_words
+        is_no = 'no' in reply_words
+        update = {'$addToSet': {'curation.replies': reply_identifier}}
+        if is_yes or is_no:
+            update['$addToSet']['curation.curators'] = '@' + operation['author']
+            update['$inc'] = get_curation_deltas(is_yes, is_no)
+        if is_yes:
+            update['$addToSet']['curation.yes_replies'] = reply_identifier
+        if is_no:
+            update['$addToSet']['curation.no_replies'] = reply_identifier
+        post_data = self.mongo_steem.retry(
+            self.mongo_steem.posts.find_one_and_update,
+            {'bot_comment': bot_comment, 'curation.replies': {'$ne': reply_identifier}},
+            update,
+            projection={'identifier': 1, 'author': 1, 'created': 1},
+        )
+        if post_data is None:
+            return
+        self.stats['replies'] += 1
+        if is_yes or is_no:
+            self.tracked_replies[reply_identifier] = (
+                post_data['identifier'], get_curation_deltas(is_yes, is_no), post_data['created']
+            )
+        if 'stop' in reply_words:
+            self.handle_stop(post_data, operation['author'], reply_identifier)
+
+    def handle_stop(self, post_data, replier, reply_identifier):
+        author = post_data['author']
+        if replier != author:
+            self.steem_client.reply_to(
+                reply_identifier, 'Sorry, only {} can unsubscribe.'.format(author)
+            )
+            return
+        self.mongo_steem.unsubscribe_user(author)
+        self.mongo_steem.retry(
+            self.mongo_steem.posts.update_one,
+            {'identifier': post_data['identifier']},
+            {'$set': {'curation.stopped': True}},
+        )
+        self.steem_client.reply_to(
+            reply_identifier,
+            'Sorry for the trouble {}, you have been removed.'.format(author),
+            priority=PRIORITY_HIGH,
+        )
+        self.stats['unsubscribes'] += 1
+
+    def record_bot_comment_vote(self, bot_comment, operation):
+        query = {'bot_comment': bot_comment}
+        requests = [UpdateOne(query, {'$addToSet': {'curation.curators': '@' + operation['voter']}})]
+        requests.extend(get_vote_requests(
+            query, operation['voter'], operation['weight'], {'curation.net_votes': 1}
+        ))
+        self.mongo_steem.retry(self.mongo_steem.posts.bulk_write, requests)
+        self.stats['bot_comment_votes'] += 1
+
+    def record_reply_vote(self, reply_identifier, operation):
+        post_identifier, deltas, _ = self.tracked_replies[reply_identifier]
+        requests = get_vote_requests(
+            {'identifier': post_identifier},
+            '{}:{}'.format(reply_identifier, operation['voter']),
+            operation['weight'],
+            deltas,
+        )
+        self.mongo_steem.retry(self.mongo_steem.posts.bulk_write, requests)
+        self.stats['reply_votes'] += 1
+
+    def format_stats(self):
+        return ', '.join(
+            '{} {}'.format(self.stats[key], key)
+            for key in ('bot_comments', 'replies', 'unsubscribes', 'bot_comment_votes', 'reply_votes')
+        )
 
 
 class SteemSentimentCommenter(object):
-    def __init__(self):
-        self.steem_client = SteemClient()
-        self.mongo_steem = MongoSteem()
+    def __init__(self, scoring_workers=SCORING_WORKERS, ingestion_mode=INGESTION_MODE,
+                 outbound_enabled=OUTBOUND_ENABLED, curation_tracking=CURATION_TRACKING,
+                 steem_client=None, mongo_steem=None, metrics_enabled=METRICS_ENABLED,
+                 outbound_sender=True):
+        if metrics_enabled:
+            start_metrics_server(METRICS, METRICS_HOST, METRICS_PORT)
+        self.steem_client = steem_client or SteemClient()
+        self.mongo_steem = mongo_steem or MongoSteem()
         self.post_cooldown = False
         self.sentiment_analyzer = PostSentimentAnalyzer()
+        self.scoring_workers = scoring_workers
+        self.ingestion_mode = ingestion_mode
+        self.scoring_pool = None
+        if scoring_workers:
+            self.scoring_pool = ScoringPool(workers=scoring_workers)
+        self.checkpoint = StreamCheckpoint(self.mongo_steem)
+        self.roundup_thread = None
+        self.curation_tracker = None
+        if curation_tracking:
+            self.curation_tracker = CurationTracker(self.steem_client, self.mongo_steem)
+            self.steem_client.operation_types = ['comment', 'vote']
+            self.steem_client.operation_handlers.append(self.curation_tracker.handle_operation)
+        self.steem_client.load_shedder.listeners.append(self.handle_shed_level)
+        if outbound_enabled:
+            self.steem_client.outbound = OutboundScheduler(self.steem_client, self.mongo_steem)
+            # without a sender the actions wait for another process's
+            # scheduler, so only one sender per account is ever running
+            if outbound_sender:
+                self.steem_client.outbound.start()
+            METRICS.set_callback(
+                'kettle_outbound_queue_depth', self.steem_client.outbound.get_queue_depth
+            )
 
     def run(self):
-        for post in self.steem_client.stream_fresh_posts():
-            if datetime.datetime.now().hour != 13 and self.post_cooldown:
-                self.post_cooldown = False
+        if self.ingestion_mode == 'async':
+            self.run_async()
+            return
+        for post in self.stream_scored_posts():
+            self.handle_post(post)
+            self.checkpoint.finish(post.block_num)
+
+    def handle_shed_level(self, level):
+        if self.steem_client.load_shedder.samples_sentences:
+            self.sentiment_analyzer.sentence_limit = SHEDDING_SENTENCE_SAMPLE
+        else:
+            self.sentiment_analyzer.sentence_limit = None
+
+    def handle_post(self, post):
+        if datetime.datetime.now().hour != ROUNDUP_HOUR and self.post_cooldown:
+            self.post_cooldown = False
+        self.save_sentiment(post)
+        if self.sentiment_analyzer.is_pos_outlier(post):
+            METRICS.inc('kettle_posts_handled_total', outcome='positive')
+            self.handle_interaction_with_content_provider(post)
+        else:
+            METRICS.inc('kettle_posts_handled_total', outcome='stored')
+        if datetime.datetime.now().hour == ROUNDUP_HOUR and not self.post_cooldown:
+            self.start_roundup()
+            self.post_cooldown = True
+
+    def start_roundup(self):
+        """
+        Builds the daily roundup on a background thread so the stream keeps
+        flowing while candidates are verified.
+        """
+        if self.roundup_thread is not None and self.roundup_thread.is_alive():
+            print('previous roundup is still running, skipping')
+            return
+        self.roundup_thread = threading.Thread(
+            target=self.run_roundup, name='roundup', daemon=True
+        )
+        self.roundup_thread.start()
+
+    def run_roundup(self):
+        try:
+            self.write_positive_article_post()
+        except Exception as e:
+            print('roundup failed')
+            print(e)
+
+    def run_async(self, max_in_flight=INGESTION_MAX_IN_FLIGHT,
+                  queue_size=INGESTION_QUEUE_SIZE):
+        """
+        Runs the bot on the asyncio ingestion engine.
+
+        SteemClient.ingest_fresh_posts fills a bounded queue from up to
+        max_in_flight concurrent post lookups. One consumer per scoring worker
+        drains it; validity checks and decisions run on a single thread so
+        they keep the ordering guarantees of the synchronous loop, while
+        scoring is handed to the scoring pool when there is one.
+
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        queue = asyncio.Queue(maxsize=queue_size)
+        METRICS.set_callback('kettle_ingestion_queue_size', queue.qsize)
+        rpc_executor = ThreadPoolExecutor(max_in_flight + 1)
+        decision_executor = ThreadPoolExecutor(1)
+        consumers = [
+            asyncio.ensure_future(self.consume_posts(queue, decision_executor))
+            for _ in range(self.scoring_workers or 1)
+        ]
+        try:
+            loop.run_until_complete(
+                self.steem_client.ingest_fresh_posts(
+                    queue, rpc_executor, max_in_flight, checkpoint=self.checkpoint
+                )
+            )
+        finally:
+            # let the consumers and the lookups still in flight see their
+            # cancellation before the loop goes away
+            all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+            pending = [task for task in all_tasks(loop) if not task.done()]
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            rpc_executor.shutdown(wait=False)
+            decision_executor.shutdown(wait=False)
+            loop.close()
+
+    async def consume_posts(self, queue, decision_executor):
+        loop = asyncio.get_event_loop()
+        while True:
+            post = await queue.get()
+            try:
+                is_valid = await loop.run_in_executor(
+                    decision_executor, self.is_post_valid, post
+                )
+                if is_valid:
+                    if self.scoring_pool is not None:
+                        await loop.run_in_executor(
+                            None, self.scoring_pool.score_one, post, self.sentiment_analyzer
+                        )
+                    await loop.run_in_executor(decision_executor, self.handle_post, post)
+            except asyncio.CancelledError:
+                # leave the post outstanding so the checkpoint stays behind it
+                raise
+            except Exception as e:
+                print(e)
+            # finishing can flush the write buffer and the checkpoint
+            await loop.run_in_executor(decision_executor, self.checkpoint.finish, post.block_num)
+            queue.task_done()
+
+    def stream_valid_posts(self):
+        for post in self.steem_client.stream_fresh_posts(checkpoint=self.checkpoint):
             if self.is_post_valid(post):
-                self.save_sentiment(post)
-                if self.sentiment_analyzer.is_pos_outlier(post):
-                    self.handle_interaction_with_content_provider(post)
-            if datetime.datetime.now().hour == 13 and not self.post_cooldown:
-                self.write_positive_article_post()
-                self.post_cooldown = True
+                yield post
+            else:
+                self.checkpoint.finish(post.block_num)
+
+    def stream_scored_posts(self):
+        valid_posts = self.stream_valid_posts()
+        if self.scoring_pool is None:
+            return valid_posts
+        return self.scoring_pool.score(valid_posts, self.sentiment_analyzer)
+
+    def close(self):
+        if self.steem_client.outbound is not None:
+            # wait for a send in progress, so it is not left marked sending
+            self.steem_client.outbound.stop()
+        if self.scoring_pool is not None:
+            self.scoring_pool.close()
+        try:
+            self.mongo_steem.close()
+            self.checkpoint.flush()
+        except ConnectionFailure as e:
+            print('could not flush to mongo on close: {}'.format(e))
 
     def is_post_valid(self, post):
         return (
@@ -350,7 +2746,6 @@ class SteemSentimentCommenter(object):
         )
 
     def handle_interaction_with_content_provider(self, post):
-        post.refresh()
         self.steem_client.upvote_post(post)
         description = self.sentiment_analyzer.get_description(post)
         self.steem_client.comment_on_post(post, description)
@@ -372,21 +2767,39 @@ class SteemSentimentCommenter(object):
             "articles a read and see if they can improve your life, inspire you and improve "
             "your day:\n\n"
         )
-        positive_posts = self.mongo_steem.get_positive_posts()
-        verified_posts = []
-        for post_data in positive_posts:
-            post = Post(post_data)
-            if self.is_post_verified_positive(post):
-                verified_posts.append(post)
-                self.mongo_steem.update_post(post, is_in_positive_article_post=True)
+        # candidates scored from a sentence sample get a full score first
+        self.mongo_steem.flush_writes()
+        self.mongo_steem.rescore_stored_posts(
+            self.sentiment_analyzer, query=self.mongo_steem.get_sampled_posts_query()
+        )
+        if self.curation_tracker is not None:
+            verified_posts = self.mongo_steem.get_curated_posts()
+            self.mongo_steem.mark_in_positive_article_post(
+                post['identifier'] for post in verified_posts
+            )
+            curators = set()
+            for post in verified_posts:
+                curators.update(post.get('curation', {}).get('curators', []))
+            print('roundup curation: {}'.format(self.curation_tracker.format_stats()))
+        else:
+            positive_posts = list(self.mongo_steem.get_positive_posts())
+            with ThreadPoolExecutor(ROUNDUP_WORKERS) as executor:
+                candidates = [
+                    post for post in executor.map(self.load_candidate, positive_posts)
+                    if post is not None
+                ]
+            self.prefetch_replies(candidates)
+            verified_posts = [post for post in candidates if self.verify_candidate(post)]
+            self.mongo_steem.flush_writes()
+            print('roundup replies: {}'.format(self.steem_client.reply_fetcher.format_stats()))
+            curators = self.get_post_curators(verified_posts)
         links = '\n\n'.join([self.get_steemit_url(post) for post in verified_posts])
-        authors = ', '.join(['@' + post.author for post in verified_posts])
+        authors = ', '.join(['@' + post['author'] for post in verified_posts])
         author_thank_you = (
             'Thanks to the authors for creating the content:\n{}\n\n'.format(
                 authors
             )
         )
-        curators = self.get_post_curators(verified_posts)
         curator_thank_you = (
             'And a very special thanks to the curators that helped ensure this '
             'content is legitimate: {}'.format(', '.join(curators))
@@ -397,6 +2810,43 @@ class SteemSentimentCommenter(object):
             print('posting: {}'.format(title))
             self.steem_client.write_post(title, body, tags)
 
+    def load_candidate(self, post_data):
+        """
+        Loads one roundup candidate from the chain on a roundup worker
+        thread, or returns None when it could not be loaded.
+        """
+        try:
+            return Post(post_data)
+        except Exception as e:
+            print('could not load {}: {}'.format(post_data.get('identifier'), e))
+
+    def prefetch_replies(self, posts):
+        """
+        Fetches the reply trees the roundup reads in two batches: the
+        candidates' replies, then the replies to the bot's comments on them.
+        """
+        reply_fetcher = self.steem_client.reply_fetcher
+        reply_fetcher.get_replies_many(posts)
+        sentiment_bot_comments = [
+            comment for comment in map(self.get_senti_bot_comment, posts)
+            if comment is not None
+        ]
+        reply_fetcher.get_replies_many(sentiment_bot_comments)
+
+    def verify_candidate(self, post):
+        """
+        Returns True when a loaded candidate makes the roundup. Its replies
+        come from the prefetched cache; the update_post writes land in the
+        Mongo write buffer and go out together.
+        """
+        try:
+            if self.is_post_verified_positive(post):
+                self.mongo_steem.update_post(post, is_in_positive_article_post=True)
+                return True
+        except Exception as e:
+            print('could not verify {}: {}'.format(post.identifier, e))
+        return False
+
     def get_post_curators(self, verified_posts):
         post_curators = set()
         for post in verified_posts:
@@ -404,27 +2854,27 @@ class SteemSentimentCommenter(object):
             post_curators = post_curators.union(
                 set(['@' + comment['voter'] for comment in sentiment_bot_comment.active_votes])
             )
-            for sentiment_bot_reply in sentiment_bot_comment.get_replies():
-                table = str.maketrans(dict.fromkeys(string.punctuation))
-                reply_words = set(sentiment_bot_reply.body.translate(table).lower().split(' '))
+            for sentiment_bot_reply in self.steem_client.reply_fetcher.get_replies(sentiment_bot_comment):
+                reply_words = get_reply_words(sentiment_bot_reply.body)
                 if 'yes' in reply_words or 'no' in reply_words:
                     post_curators.add('@' + sentiment_bot_reply.author)
         return post_curators
 
     def get_senti_bot_comment(self, post):
-        for reply in post.get_replies():
+        for reply in self.steem_client.reply_fetcher.get_replies(post):
             if reply.author == self.steem_client.account:
                 return reply
 
     def is_post_verified_positive(self, post):
         sentiment_bot_comment = self.get_senti_bot_comment(post)
+        if sentiment_bot_comment is None:
+            return False
         if sentiment_bot_comment.net_votes > 0:
             return True
         no_count = 0
         yes_count = 0
-        for sentiment_bot_reply in sentiment_bot_comment.get_replies():
-            table = str.maketrans(dict.fromkeys(string.punctuation))
-            reply_words = set(sentiment_bot_reply.body.translate(table).lower().split(' '))
+        for sentiment_bot_reply in self.steem_client.reply_fetcher.get_replies(sentiment_bot_comment):
+            reply_words = get_reply_words(sentiment_bot_reply.body)
             if 'stop' in reply_words:
                 if post.author == sentiment_bot_reply.author:
                     self.mongo_steem.unsubscribe_user(post.author)
@@ -432,7 +2882,8 @@ class SteemSentimentCommenter(object):
                         sentiment_bot_reply,
                         (
                             'Sorry for the trouble {}, you have been removed.'.format(post.author)
-                        )
+                        ),
+                        priority=PRIORITY_HIGH,
                     )
                     return False
                 else:
@@ -450,15 +2901,67 @@ class SteemSentimentCommenter(object):
 
 
 def run_commenter():
+    """
+    Runs the commenter, building a new one after every failure.
+
+    Restarts wait a random time up to a limit that doubles from
+    RESTART_BACKOFF with every failure in a row, to at most
+    RESTART_MAX_BACKOFF seconds, so an outage does not turn into a storm of
+    new connections. A run that lasted RESTART_STABLE_SECONDS starts the
+    backoff over.
+
+    """
+    install_profiler(
+        PROFILING_ENABLED, PROFILING_SIGNAL, interval=PROFILING_INTERVAL_MS / 1000.0,
+        dump_seconds=PROFILING_DUMP_SECONDS, directory=PROFILING_DIRECTORY,
+        functions=PROFILING_FUNCTIONS, report=record_profile_times,
+    )
+    failures = 0
+    while True:
+        commenter = None
+        started = time.time()
+        try:
+            commenter = SteemSentimentCommenter()
+            commenter.run()
+            return
+        except KeyboardInterrupt:
+            print('time to exit')
+            close_commenter(commenter)
+            return
+        except Exception as e:
+            print('The whole thing failed!')
+            print(e)
+            close_commenter(commenter)
+        if time.time() - started >= RESTART_STABLE_SECONDS:
+            failures = 0
+        delay = random.uniform(
+            0, min(RESTART_MAX_BACKOFF, RESTART_BACKOFF * 2 ** min(failures, 16))
+        )
+        failures += 1
+        print('restarting in {:.1f}s'.format(delay))
+        time.sleep(delay)
+
+def close_commenter(commenter):
+    if commenter is None:
+        return
     try:
-        commenter = SteemSentimentCommenter()
-        commenter.run()
-    except KeyboardInterrupt:
-        print('time to exit')
+        commenter.close()
     except Exception as e:
-        print('The whole thing failed!')
-        print(e)
-        run_commenter()
+        print('could not close the commenter: {}'.format(e))
+
+def run_roundup():
+    """
+    Writes the daily roundup once. Its actions are queued for the outbound
+    sender of the running bot, or of tasks.run_task under celery.
+    """
+    commenter = SteemSentimentCommenter(scoring_workers=0, outbound_sender=False)
+    try:
+        commenter.write_positive_article_post()
+    finally:
+        commenter.close()
 
 if __name__ == '__main__':
-    run_commenter()
+    if sys.argv[1:] == ['roundup']:
+        run_roundup()
+    else:
+        run_commenter()
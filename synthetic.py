@@ -0,0 +1,136 @@
+import datetime
+import random
+
+from sentiment_bot import MongoSteem
+
+COMMON_WORDS = (
+    'the of and to in is you that it he was for on are as with his they at be this '
+    'have from or one had by word but not what all were we when your can said there '
+    'use an each which she do how their if will up other about out many then them '
+    'these so some her would make like him into time has look two more write go see '
+    'number no way could people my than first water been call who oil its now find '
+    'long down day did get come made may part'
+).split()
+POSITIVE_WORDS = (
+    'great happy love wonderful amazing grateful inspiring beautiful joy kind hope '
+    'excellent brilliant delighted peaceful proud thankful'
+).split()
+NEGATIVE_WORDS = (
+    'sad terrible awful hate angry broken fear lonely pain worst disappointed '
+    'miserable hopeless cruel'
+).split()
+OTHER_LANGUAGE_WORDS = (
+    'el la los que por para una con sobre muy pero como donde cuando porque '
+    'der die das und nicht mit auf ist ein eine'
+).split()
+CATEGORIES = ['life', 'photography', 'steemit', 'travel', 'food', 'nsfw', 'bitcoin']
+
+
+class SyntheticPost(dict):
+    """
+    Just enough of a steem Post for the filters and the sentiment analyzer.
+    """
+    def __init__(self, post_data):
+        super(SyntheticPost, self).__init__(post_data)
+        for key, value in post_data.items():
+            setattr(self, key, value)
+
+    def is_main_post(self):
+        return self.depth == 0
+
+    def time_elapsed(self):
+        return datetime.datetime.utcnow() - self.created
+
+
+def get_sentence(rng, mood):
+    words = [rng.choice(COMMON_WORDS) for _ in range(rng.randint(6, 18))]
+    for _ in range(rng.randint(0, 3)):
+        words.insert(rng.randrange(len(words)), rng.choice(mood))
+    return ' '.join(words).capitalize() + rng.choice(['.', '.', '!', '?'])
+
+def get_synthetic_body(rng):
+    """
+    Builds a markdown post of 300 to 1500 words in the shape Steem posts
+    usually take: headings, images, links, lists and quotes around prose.
+    About one post in ten is not English.
+    """
+    if rng.random() < 0.1:
+        return ' '.join(rng.choice(OTHER_LANGUAGE_WORDS) for _ in range(rng.randint(300, 1500)))
+    mood = rng.choice([POSITIVE_WORDS, NEGATIVE_WORDS, COMMON_WORDS])
+    target = rng.randint(300, 1500)
+    parts = []
+    words = 0
+    while words < target:
+        kind = rng.random()
+        if kind < 0.1:
+            parts.append('## ' + get_sentence(rng, mood).rstrip('.!?'))
+        elif kind < 0.2:
+            parts.append('![image](https://steemitimages.com/DQm{:x}/photo.jpg)'.format(
+                rng.getrandbits(64)
+            ))
+        elif kind < 0.3:
+            parts.append('\n'.join('- ' + get_sentence(rng, mood) for _ in range(3)))
+        elif kind < 0.35:
+            parts.append('> ' + get_sentence(rng, mood))
+        else:
+            paragraph = ' '.join(get_sentence(rng, mood) for _ in range(rng.randint(2, 6)))
+            if rng.random() < 0.3:
+                paragraph += ' [Read more](https://steemit.com/@someone/post-{})'.format(
+                    rng.randint(0, 10000)
+                )
+            parts.append(paragraph)
+        words += len(parts[-1].split(' '))
+    return '\n\n'.join(parts)
+
+def get_synthetic_corpus(count, seed=0):
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    corpus = []
+    for number in range(count):
+        author = 'author{}'.format(rng.randint(0, count // 4 + 1))
+        permlink = 'post-{}'.format(number)
+        corpus.append({
+            'id': number,
+            'identifier': '{}/{}'.format(author, permlink),
+            'author': author,
+            'permlink': permlink,
+            'category': rng.choice(CATEGORIES),
+            'tags': [rng.choice(CATEGORIES)],
+            'allow_votes': rng.random() > 0.02,
+            'depth': 0 if rng.random() < 0.8 else 1,
+            'created': now - datetime.timedelta(minutes=rng.uniform(0, 30)),
+            'url': '/life/@{}/{}'.format(author, permlink),
+            'body': get_synthetic_body(rng),
+        })
+    return corpus
+
+
+class InMemoryMongoSteem(MongoSteem):
+    """
+    MongoSteem on a mongomock client, for runs without a local mongod.
+    """
+    def init_collections(self):
+        import mongomock
+        db = getattr(mongomock.MongoClient(), self.db_name)
+        self.posts = db.posts
+        self.users = db.users
+        self.state = db.state
+        self.outbound = db.outbound
+
+
+def get_mongo_steem(target, write_buffer_size, db_name='kettle_benchmark'):
+    """
+    Returns a MongoSteem on an empty posts collection, in memory when target
+    is 'memory' and on the mongod at target (host:port) otherwise.
+    """
+    if target == 'memory':
+        return InMemoryMongoSteem(
+            db_name=db_name, write_buffer_size=write_buffer_size, ensure_indexes=False,
+        )
+    host, _, port = target.partition(':')
+    mongo_steem = MongoSteem(
+        host=host, port=int(port or 27017), db_name=db_name,
+        write_buffer_size=write_buffer_size,
+    )
+    mongo_steem.posts.delete_many({})
+    return mongo_steem
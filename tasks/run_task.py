@@ -1,5 +1,56 @@
-from .tasks import longtime_add
-import time
+from __future__ import absolute_import, print_function
+
+from sentiment_bot import (
+    CURATION_TRACKING, OUTBOUND_ENABLED, CurationTracker, MongoSteem, OutboundScheduler,
+    SteemClient, StreamCheckpoint,
+)
+from .tasks import filter_post
+
+
+def publish_post_identifiers():
+    """
+    Streams comment operations and publishes each post identifier to the
+    filter queue; everything else happens on the celery workers. Curation
+    tallies are kept here, in stream order, when curation tracking is on,
+    and this is the one process that sends the votes, comments and posts
+    the workers queue.
+
+    Run with ``python -m tasks.run_task``, or under compose with
+    docker-compose.celery.yml on top of docker-compose.yml.
+
+    """
+    steem_client = SteemClient()
+    mongo_steem = MongoSteem()
+    checkpoint = StreamCheckpoint(mongo_steem, name='celery_publisher')
+    if OUTBOUND_ENABLED:
+        steem_client.outbound = OutboundScheduler(steem_client, mongo_steem)
+        steem_client.outbound.start()
+    if CURATION_TRACKING:
+        curation_tracker = CurationTracker(steem_client, mongo_steem)
+        steem_client.operation_types = ['comment', 'vote']
+        steem_client.operation_handlers.append(curation_tracker.handle_operation)
+    stream = steem_client.stream_comment_operations(checkpoint)
+    try:
+        while True:
+            try:
+                operation = next(stream)
+            except Exception as e:
+                print(e)
+                stream = steem_client.stream_comment_operations(checkpoint)
+                continue
+            if not steem_client.handle_operation(operation):
+                continue
+            if checkpoint.is_stale(operation['block_num']):
+                checkpoint.skip(operation['block_num'])
+                continue
+            checkpoint.start(operation['block_num'])
+            filter_post.delay('{}/{}'.format(operation['author'], operation['permlink']))
+            checkpoint.finish(operation['block_num'])
+    finally:
+        if steem_client.outbound is not None:
+            steem_client.outbound.stop()
+        checkpoint.flush()
+
+
 if __name__ == '__main__':
-    result = longtime_add.delay()
-    print 'Task result:', result.result
+    publish_post_identifiers()
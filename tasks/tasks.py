@@ -1,7 +1,95 @@
 from __future__ import absolute_import, unicode_literals
+
+from steem.post import Post
+from steembase.exceptions import PostDoesNotExist
+
+from sentiment_bot import (
+    OUTBOUND_ENABLED, MongoSteem, OutboundScheduler, PostSentimentAnalyzer, SteemClient,
+    run_roundup,
+)
 from .celery import app
 
+# Each worker process builds its clients once, on the first task that needs
+# them, so a worker that only consumes one queue never loads the others.
+_steem_client = None
+_mongo_steem = None
+_sentiment_analyzer = None
+
+
+def get_steem_client():
+    global _steem_client
+    if _steem_client is None:
+        _steem_client = SteemClient()
+        if OUTBOUND_ENABLED:
+            # votes and comments are queued for the publisher's sender in
+            # tasks.run_task, which keeps to the per-account limits
+            _steem_client.outbound = OutboundScheduler(_steem_client, get_mongo_steem())
+    return _steem_client
+
+
+def get_mongo_steem():
+    global _mongo_steem
+    if _mongo_steem is None:
+        # tasks are the unit of work here, so write through instead of
+        # buffering inside a worker that may be stopped at any time; every
+        # storage worker writes posts, so none of them is the only writer
+        _mongo_steem = MongoSteem(write_buffer_size=1, single_writer=False)
+    return _mongo_steem
+
+
+def get_sentiment_analyzer():
+    global _sentiment_analyzer
+    if _sentiment_analyzer is None:
+        _sentiment_analyzer = PostSentimentAnalyzer()
+    return _sentiment_analyzer
+
+
+@app.task
+def filter_post(identifier):
+    """
+    Runs the freshness, spam and duplicate checks and hands the exported
+    post to the scoring queue.
+    """
+    steem_client = get_steem_client()
+    mongo_steem = get_mongo_steem()
+    try:
+        post = Post(identifier, steemd_instance=steem_client.steem)
+    except PostDoesNotExist:
+        return False
+    if not (
+        steem_client.is_fresh_post(post)
+        and mongo_steem.is_post_valid(post)
+        and steem_client.is_post_valid(post)
+    ):
+        return False
+    score_post.delay(mongo_steem.get_post_data_for_storage(post))
+    return True
+
+
+@app.task
+def score_post(post_data):
+    sentiment_analyzer = get_sentiment_analyzer()
+    result = sentiment_analyzer.score_body(post_data['body'])
+    store_post.delay(post_data, sentiment_analyzer.result_to_mongo(result))
+    if result.is_pos_outlier:
+        interact_with_author.delay(post_data['identifier'])
+    return result.avg_normalized_polarity
+
+
+@app.task
+def store_post(post_data, sentiment):
+    post_data.update(sentiment)
+    get_mongo_steem().store_post_data(post_data)
+
+
+@app.task
+def interact_with_author(identifier):
+    steem_client = get_steem_client()
+    post = Post(identifier, steemd_instance=steem_client.steem)
+    steem_client.upvote_post(post)
+    steem_client.comment_on_post(post, get_sentiment_analyzer().get_description(post))
+
+
 @app.task
-def longtime_add():
-    with open('x.txt' , 'w+') as fh:
-        fh.write('hello')
+def write_roundup():
+    run_roundup()
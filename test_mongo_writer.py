@@ -1,4 +1,44 @@
-from unittest import TestCase
+import datetime
+import inspect
+import queue
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+from mongomock.collection import BulkOperationBuilder
+
+from metrics import MetricsRegistry
+from profiler import SamplingProfiler
+from sentiment_bot import (
+    BLOCKS_PER_MINUTE, EXPIRATION_MINUTES, METRICS, PRIORITY_CATEGORIES, CurationTracker,
+    LoadShedder,
+    OutboundScheduler, PostSentimentAnalyzer, ReplyFetcher, ScoringPool, SeenPostWindow, SteemClient,
+    StoredPostBody, StreamCheckpoint,
+    get_curation_deltas, get_vote_requests, instrument_steemd, sample_sentences,
+)
+from synthetic import SyntheticPost, get_mongo_steem, get_synthetic_corpus
+from tasks import tasks
+from tasks.celery import app
+
+
+def add_update_without_sort(add_update):
+    """
+    Drops the sort argument newer pymongo releases pass for every UpdateOne,
+    which older mongomock bulk builders do not take, so bulk_write still runs
+    the real requests.
+    """
+    def wrapper(self, *args, **kwargs):
+        if kwargs.get('sort') is None:
+            kwargs.pop('sort', None)
+        return add_update(self, *args, **kwargs)
+
+    return wrapper
+
+
+if 'sort' not in inspect.signature(BulkOperationBuilder.add_update).parameters:
+    BulkOperationBuilder.add_update = add_update_without_sort(BulkOperationBuilder.add_update)
 
 
 class TestSteemClientInit(TestCase):
@@ -28,6 +68,580 @@ class TestStreamFreshPosts(TestCase):
     def test_general_exception(self):
         pass
 
+class TestStreamCheckpoint(TestCase):
+
+    def setUp(self):
+        self.mongo_steem = get_mongo_steem('memory', write_buffer_size=1, db_name='test_checkpoint')
+        self.checkpoint = StreamCheckpoint(
+            self.mongo_steem, every_blocks=1, every_seconds=0, catch_up='full'
+        )
+
+    def get_stored_block(self):
+        return self.mongo_steem.state.find_one({'_id': 'comment_stream'})['block_num']
+
+    def test_out_of_order_finishes(self):
+        for block_num in (10, 11, 12):
+            self.checkpoint.start(block_num)
+        self.assertEqual(self.checkpoint.safe_block, 9)
+        self.checkpoint.finish(12)
+        self.checkpoint.finish(11)
+        self.assertEqual(self.checkpoint.safe_block, 9)
+        self.checkpoint.finish(10)
+        # 12 may still have unread operations
+        self.assertEqual(self.checkpoint.safe_block, 11)
+        self.assertEqual(self.get_stored_block(), 11)
+
+    def test_oldest_outstanding_block_holds_the_checkpoint(self):
+        self.checkpoint.start(10)
+        self.checkpoint.start(10)
+        self.checkpoint.start(11)
+        self.checkpoint.finish(10)
+        self.checkpoint.start(12)
+        self.assertEqual(self.checkpoint.safe_block, 9)
+        self.checkpoint.finish(10)
+        self.assertEqual(self.checkpoint.safe_block, 10)
+
+    def test_finish_after_reset_is_ignored(self):
+        self.checkpoint.start(10)
+        self.checkpoint.start(11)
+        self.checkpoint.reset()
+        self.checkpoint.finish(10)
+        self.assertEqual(self.checkpoint.safe_block, 9)
+        self.assertEqual(self.checkpoint.get_start_block(100), 10)
+        self.checkpoint.start(10)
+        self.checkpoint.start(11)
+        self.checkpoint.finish(10)
+        self.assertEqual(self.checkpoint.safe_block, 10)
+
+    def test_concurrent_starts_and_finishes(self):
+        # like the scoring pool's feeder starting and filtering out posts
+        # while the main loop finishes the scored ones
+        handled = queue.Queue()
+        errors = []
+        # write once, at the end, to keep the threads on the bookkeeping
+        self.checkpoint.every_blocks = self.checkpoint.every_seconds = float('inf')
+
+        def finish_handled():
+            try:
+                while True:
+                    block_num = handled.get()
+                    if block_num is None:
+                        return
+                    self.checkpoint.finish(block_num)
+            except Exception as e:
+                errors.append(e)
+
+        finisher = threading.Thread(target=finish_handled)
+        finisher.start()
+        for block_num in range(1, 5001):
+            self.checkpoint.start(block_num)
+            self.checkpoint.start(block_num)
+            handled.put(block_num)
+            self.checkpoint.finish(block_num)
+        handled.put(None)
+        finisher.join()
+        self.assertEqual(errors, [])
+        self.assertFalse(self.checkpoint.outstanding)
+        self.assertEqual(self.checkpoint.safe_block, 4999)
+
+class TestFreshCatchUp(TestCase):
+
+    def setUp(self):
+        mongo_steem = get_mongo_steem('memory', write_buffer_size=1, db_name='test_catch_up')
+        mongo_steem.state.insert_one({'_id': 'comment_stream', 'block_num': 1000})
+        self.checkpoint = StreamCheckpoint(mongo_steem, catch_up='fresh')
+        self.head = 1000 + EXPIRATION_MINUTES * BLOCKS_PER_MINUTE + 500
+        self.fresh_block = self.head - EXPIRATION_MINUTES * BLOCKS_PER_MINUTE
+
+    def test_skips_stale_blocks_without_operation_handlers(self):
+        self.assertEqual(self.checkpoint.get_start_block(self.head), self.fresh_block)
+        self.assertFalse(self.checkpoint.is_stale(1001))
+
+    def test_replays_stale_blocks_to_operation_handlers(self):
+        self.assertEqual(
+            self.checkpoint.get_start_block(self.head, replay_operations=True), 1001
+        )
+        self.assertTrue(self.checkpoint.is_stale(1001))
+        self.assertFalse(self.checkpoint.is_stale(self.fresh_block))
+        self.checkpoint.skip(1001)
+        self.checkpoint.skip(1002)
+        self.assertEqual(self.checkpoint.safe_block, 1001)
+
+class TestSeenPostWindow(TestCase):
+
+    def test_ids_expire_with_the_window(self):
+        window = SeenPostWindow(window_seconds=60)
+        with mock.patch('time.time', return_value=1000.0):
+            window.add(1)
+        with mock.patch('time.time', return_value=1059.0):
+            window.add(2)
+        self.assertIn(1, window)
+        with mock.patch('time.time', return_value=1061.0):
+            window.add(3)
+        self.assertNotIn(1, window)
+        self.assertIn(2, window)
+        self.assertEqual(len(window), 2)
+
+    def test_eviction_makes_the_window_incomplete(self):
+        window = SeenPostWindow(window_seconds=60, max_entries=2)
+        with mock.patch('time.time', return_value=1000.0):
+            for post_id in (1, 2, 3):
+                window.add(post_id)
+            self.assertNotIn(1, window)
+            self.assertFalse(window.is_complete)
+        with mock.patch('time.time', return_value=1059.0):
+            self.assertFalse(window.is_complete)
+        # by now the evicted id would have expired anyway
+        with mock.patch('time.time', return_value=1060.0):
+            self.assertTrue(window.is_complete)
+
+class TestIsPostNew(TestCase):
+
+    def setUp(self):
+        self.mongo_steem = get_mongo_steem('memory', write_buffer_size=1, db_name='test_dedup')
+        self.corpus = get_synthetic_corpus(3)
+        self.posts = [SyntheticPost(post_data) for post_data in self.corpus]
+
+    def test_posts_stored_by_this_process_are_seen_without_mongo(self):
+        self.mongo_steem.store_post_data(dict(self.corpus[0]))
+        self.assertFalse(self.mongo_steem.is_post_new(self.posts[0]))
+        self.assertEqual(self.mongo_steem.dedup_stats['mongo_checks'], 0)
+
+    def test_local_miss_checks_mongo(self):
+        self.mongo_steem.single_writer = False
+        # stored by another instance of the bot
+        self.mongo_steem.posts.insert_one(dict(self.corpus[0]))
+        self.assertFalse(self.mongo_steem.is_post_new(self.posts[0]))
+        self.assertTrue(self.mongo_steem.is_post_new(self.posts[1]))
+        self.assertEqual(self.mongo_steem.dedup_stats['mongo_checks'], 2)
+
+    def test_single_writer_trusts_a_complete_window(self):
+        self.mongo_steem.single_writer = True
+        self.assertTrue(self.mongo_steem.is_post_new(self.posts[0]))
+        self.assertEqual(self.mongo_steem.dedup_stats['new'], 1)
+        self.assertEqual(self.mongo_steem.dedup_stats['mongo_checks'], 0)
+
+    def test_single_writer_checks_mongo_once_ids_were_evicted(self):
+        self.mongo_steem.single_writer = True
+        self.mongo_steem.seen_posts.max_entries = 1
+        self.mongo_steem.store_post_data(dict(self.corpus[0]))
+        self.mongo_steem.store_post_data(dict(self.corpus[1]))
+        self.assertFalse(self.mongo_steem.is_post_new(self.posts[0]))
+        self.assertTrue(self.mongo_steem.is_post_new(self.posts[2]))
+        self.assertEqual(self.mongo_steem.dedup_stats['mongo_checks'], 2)
+
+    def test_window_is_seeded_from_recent_posts(self):
+        recent, old = dict(self.corpus[0]), dict(self.corpus[1])
+        old['created'] = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        self.mongo_steem.posts.insert_many([recent, old])
+        self.mongo_steem.seen_posts = SeenPostWindow(self.mongo_steem.seen_posts.window_seconds)
+        self.mongo_steem.load_seen_posts()
+        self.assertIn(recent['id'], self.mongo_steem.seen_posts)
+        self.assertNotIn(old['id'], self.mongo_steem.seen_posts)
+
+class TestOutboundScheduler(TestCase):
+
+    def setUp(self):
+        self.mongo_steem = get_mongo_steem('memory', write_buffer_size=1, db_name='test_outbound')
+        self.outbound = OutboundScheduler(None, self.mongo_steem)
+
+    def test_same_action_is_queued_once(self):
+        self.outbound.enqueue('vote', {'identifier': 'author/post'})
+        self.outbound.enqueue('vote', {'identifier': 'author/post'})
+        self.outbound.enqueue('comment', {'identifier': 'author/post', 'body': 'Thanks'})
+        self.assertEqual(len(list(self.mongo_steem.outbound.find())), 2)
+        self.assertEqual(self.outbound.stats['enqueued'], 2)
+
+    def test_actions_interrupted_while_sending_are_not_resent(self):
+        self.outbound.enqueue('vote', {'identifier': 'author/post'})
+        self.mongo_steem.outbound.update_many({}, {'$set': {'status': 'sending'}})
+        self.outbound.start()
+        self.outbound.stop()
+        self.assertEqual(
+            self.mongo_steem.outbound.find_one({})['status'], 'interrupted'
+        )
+
+class TestUpdatePosts(TestCase):
+
+    def setUp(self):
+        self.mongo_steem = get_mongo_steem('memory', write_buffer_size=1, db_name='test_update_posts')
+        self.chain = {}
+        for identifier, tags, net_votes in [
+            ('author/unchanged', ['life', 'food'], 1),
+            ('author/reordered', ['life', 'food'], 2),
+            ('author/voted', ['life'], 3),
+        ]:
+            post_data = {'identifier': identifier, 'tags': tags, 'net_votes': net_votes}
+            self.mongo_steem.posts.insert_one(dict(post_data))
+            self.chain[identifier] = post_data
+        self.chain['author/reordered']['tags'] = ['food', 'life']
+        self.chain['author/voted']['net_votes'] = 7
+        # deleted from the chain, so it cannot be loaded
+        self.mongo_steem.posts.insert_one({'identifier': 'author/deleted', 'tags': []})
+        for patch in (
+            mock.patch('sentiment_bot.Post', lambda identifier: SyntheticPost(self.chain[identifier])),
+            mock.patch.object(
+                self.mongo_steem.posts, 'bulk_write', wraps=self.mongo_steem.posts.bulk_write
+            ),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_only_changed_fields_are_written(self):
+        totals = self.mongo_steem.update_posts(workers=2, batch_size=10, report_every=0)
+        self.assertEqual(totals, {'posts': 4, 'changed': 1, 'failed': 1})
+        self.assertEqual(self.mongo_steem.posts.bulk_write.call_count, 1)
+        (requests,), kwargs = self.mongo_steem.posts.bulk_write.call_args
+        self.assertEqual(kwargs, {'ordered': False})
+        voted = self.mongo_steem.posts.find_one({'identifier': 'author/voted'})
+        self.assertEqual(
+            [(request._filter, request._doc) for request in requests],
+            [({'_id': voted['_id']}, {'$set': {'net_votes': 7}})],
+        )
+        self.assertEqual(voted['net_votes'], 7)
+        reordered = self.mongo_steem.posts.find_one({'identifier': 'author/reordered'})
+        self.assertEqual(reordered['tags'], ['life', 'food'])
+
+    def test_unchanged_posts_are_not_written(self):
+        self.mongo_steem.update_posts(workers=2, batch_size=10, report_every=0)
+        self.mongo_steem.posts.bulk_write.reset_mock()
+        totals = self.mongo_steem.update_posts(workers=2, batch_size=2, report_every=0)
+        self.assertEqual(totals, {'posts': 4, 'changed': 0, 'failed': 1})
+        self.assertFalse(self.mongo_steem.posts.bulk_write.called)
+
+class TestCuration(TestCase):
+
+    def setUp(self):
+        self.mongo_steem = get_mongo_steem('memory', write_buffer_size=1, db_name='test_curation')
+        self.steem_client = mock.Mock(account='kettle')
+        self.mongo_steem.posts.insert_one({
+            'identifier': 'author/post',
+            'author': 'author',
+            'created': datetime.datetime.now(),
+            'bot_comment': 'kettle/re-post',
+        })
+        self.tracker = CurationTracker(self.steem_client, self.mongo_steem, account='kettle')
+
+    def get_curation(self):
+        return self.mongo_steem.posts.find_one({'identifier': 'author/post'}).get('curation', {})
+
+    def vote(self, voter, weight):
+        self.mongo_steem.posts.bulk_write(get_vote_requests(
+            {'identifier': 'author/post'}, voter, weight, {'curation.net_votes': 1}
+        ))
+
+    def reply(self, author, body):
+        self.tracker.handle_operation({
+            'type': 'comment',
+            'author': author,
+            'permlink': 're-re-post-{}'.format(author),
+            'parent_author': 'kettle',
+            'parent_permlink': 're-post',
+            'body': body,
+        })
+
+    def test_vote_requests_count_each_net_vote_once(self):
+        self.vote('alice', 10000)
+        self.vote('alice', 5000)
+        self.assertEqual(self.get_curation()['net_votes'], 1)
+        self.vote('alice', -10000)
+        self.assertEqual(self.get_curation()['net_votes'], -1)
+        self.vote('alice', -10000)
+        self.assertEqual(self.get_curation()['net_votes'], -1)
+        self.vote('alice', 0)
+        self.vote('alice', 0)
+        self.assertEqual(self.get_curation()['net_votes'], 0)
+        self.assertEqual(self.get_curation()['upvoters'], [])
+        self.assertEqual(self.get_curation()['downvoters'], [])
+
+    def test_curation_deltas(self):
+        self.assertEqual(
+            get_curation_deltas(True, False), {'curation.score': 1, 'curation.yes': 1}
+        )
+        self.assertEqual(
+            get_curation_deltas(True, True),
+            {'curation.score': 0, 'curation.yes': 1, 'curation.no': 1},
+        )
+
+    def test_replayed_replies_are_counted_once(self):
+        self.reply('bob', 'Yes, this is a great post')
+        self.reply('bob', 'Yes, this is a great post')
+        self.reply('carol', 'no')
+        curation = self.get_curation()
+        self.assertEqual(curation['yes'], 1)
+        self.assertEqual(curation['no'], 1)
+        self.assertEqual(curation['score'], 0)
+        self.assertEqual(sorted(curation['curators']), ['@bob', '@carol'])
+        self.assertEqual(len(curation['replies']), 2)
+
+    def test_replayed_stop_is_handled_once(self):
+        self.reply('author', 'please stop')
+        self.reply('author', 'please stop')
+        self.assertTrue(self.get_curation()['stopped'])
+        self.assertIn('author', self.mongo_steem.unsubscribed_users)
+        self.assertEqual(self.steem_client.reply_to.call_count, 1)
+
+    def test_stop_from_someone_else_is_refused(self):
+        self.reply('mallory', 'stop')
+        self.assertNotIn('stopped', self.get_curation())
+        self.assertNotIn('author', self.mongo_steem.unsubscribed_users)
+        self.assertEqual(self.steem_client.reply_to.call_count, 1)
+
+class TestCeleryTasks(TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, app.conf, 'task_always_eager', app.conf.task_always_eager)
+        app.conf.task_always_eager = True
+        self.mongo_steem = get_mongo_steem('memory', write_buffer_size=1, db_name='test_tasks')
+        # steem is only used for RPCs, which Post is patched out of
+        self.steem_client = SteemClient(steem=object())
+        self.steem_client.outbound = OutboundScheduler(self.steem_client, self.mongo_steem)
+        self.posts = {}
+        for patch in (
+            mock.patch.object(tasks, '_mongo_steem', self.mongo_steem),
+            mock.patch.object(tasks, '_steem_client', self.steem_client),
+            mock.patch.object(
+                tasks, 'Post',
+                lambda identifier, steemd_instance=None: SyntheticPost(self.posts[identifier]),
+            ),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def add_post(self, number, body):
+        post_data = get_synthetic_corpus(number + 1)[number]
+        post_data['body'] = body
+        self.posts[post_data['identifier']] = post_data
+        return dict(post_data)
+
+    def test_positive_post_is_scored_stored_and_interacted_with(self):
+        post_data = self.add_post(0, 'I love this wonderful, happy and inspiring day! ' * 20)
+        tasks.score_post.delay(post_data)
+        stored = self.mongo_steem.posts.find_one({'identifier': post_data['identifier']})
+        self.assertTrue(stored['is_pos_outlier'])
+        queued = sorted(
+            outbound_action['action'] for outbound_action in self.mongo_steem.outbound.find(
+                {'payload.identifier': post_data['identifier']}
+            )
+        )
+        self.assertEqual(queued, ['comment', 'vote'])
+
+    def test_other_posts_are_only_stored(self):
+        post_data = self.add_post(1, 'This was a sad, awful and miserable day. ' * 20)
+        tasks.score_post.delay(post_data)
+        stored = self.mongo_steem.posts.find_one({'identifier': post_data['identifier']})
+        self.assertFalse(stored['is_pos_outlier'])
+        self.assertIsNone(self.mongo_steem.outbound.find_one())
+
+class TestMetricsRegistry(TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry([
+            ('test_total', 'counter', 'Things counted.'),
+            ('test_seconds', 'histogram', 'Things timed.'),
+            ('test_depth', 'gauge', 'Things waiting.'),
+        ], buckets=(0.1, 1.0))
+
+    def test_render_counters_and_gauges(self):
+        self.registry.inc('test_total', kind='a')
+        self.registry.inc('test_total', 2, kind='a')
+        self.registry.set_callback('test_depth', lambda: 7)
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[:3], [
+            '# HELP test_total Things counted.',
+            '# TYPE test_total counter',
+            'test_total{kind="a"} 3',
+        ])
+        self.assertIn('test_depth 7', lines)
+
+    def test_histogram_buckets_are_cumulative(self):
+        for value in (0.05, 0.5, 0.5, 5.0):
+            self.registry.observe('test_seconds', value, method='get')
+        lines = self.registry.render().splitlines()
+        self.assertIn('test_seconds_bucket{method="get",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{method="get",le="1.0"} 3', lines)
+        self.assertIn('test_seconds_bucket{method="get",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_sum{method="get"} 6.05', lines)
+        self.assertIn('test_seconds_count{method="get"} 4', lines)
+
+    def test_label_values_are_escaped(self):
+        self.registry.inc('test_total', kind='say "hi"\\now\nplease')
+        self.assertIn(
+            'test_total{kind="say \\"hi\\"\\\\now\\nplease"} 1',
+            self.registry.render().splitlines(),
+        )
+
+    def test_failing_callback_keeps_rendering(self):
+        self.registry.set_callback('test_depth', lambda: 1 / 0)
+        self.assertIn('# TYPE test_depth gauge', self.registry.render())
+
+    def test_instrument_steemd_counts_errors(self):
+        steemd = mock.Mock()
+        steemd.call.side_effect = [{'head_block_number': 1}, OSError('timed out')]
+        instrument_steemd(steemd)
+        before = METRICS.get('kettle_rpc_errors_total', method='test_method') or 0
+        self.assertEqual(steemd.call('test_method'), {'head_block_number': 1})
+        with self.assertRaises(OSError):
+            steemd.call('test_method')
+        self.assertEqual(METRICS.get('kettle_rpc_errors_total', method='test_method'), before + 1)
+        with METRICS.lock:
+            histogram = METRICS.histograms[('kettle_rpc_seconds', (('method', 'test_method'),))]
+        self.assertGreaterEqual(histogram[-1], 2)
+
+class ProfiledTarget(object):
+    def block(self, event):
+        event.wait()
+
+class ProfiledTargetHelper(object):
+    def block(self, event):
+        event.wait()
+
+class TestSamplingProfiler(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = SamplingProfiler(
+            interval=0.001, directory=self.directory, functions=['ProfiledTarget'],
+        )
+
+    def run_blocked(self, target):
+        event = threading.Event()
+        thread = threading.Thread(target=target.block, args=(event,), daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(event.set)
+        while not any(
+            frame.f_code.co_name == 'block' for frame in self.get_frames(thread.ident)
+        ):
+            event.wait(0.001)
+
+    def get_frames(self, ident):
+        frame = sys._current_frames().get(ident)
+        while frame is not None:
+            yield frame
+            frame = frame.f_back
+
+    def test_class_name_covers_its_methods(self):
+        self.run_blocked(ProfiledTarget())
+        self.run_blocked(ProfiledTargetHelper())
+        self.profiler.sample()
+        self.profiler.sample()
+        samples = dict(self.profiler.function_samples)
+        self.assertEqual(samples, {
+            'test_mongo_writer.py:ProfiledTarget.block': {'total': 2, 'self': 0},
+        })
+        self.assertTrue(self.profiler.targets['test_mongo_writer.py:ProfiledTarget.block'])
+        self.assertFalse(
+            self.profiler.targets['test_mongo_writer.py:ProfiledTargetHelper.block']
+        )
+
+    def test_times_use_the_measured_spacing(self):
+        self.profiler.function_samples['x.py:f']['total'] = 2
+        self.assertEqual(self.profiler.get_function_times(), {'x.py:f': {'total': 0.002, 'self': 0}})
+        self.profiler.samples = 4
+        self.profiler.elapsed = 0.02
+        self.assertEqual(self.profiler.get_function_times(), {'x.py:f': {'total': 0.01, 'self': 0}})
+
+    def test_toggle_during_the_last_dump_restarts(self):
+        self.profiler.dump = lambda: time.sleep(0.2)
+        self.profiler.start()
+        self.addCleanup(self.profiler.stop)
+        self.profiler.toggle()
+        self.assertFalse(self.profiler.is_running)
+        self.profiler.toggle()
+        self.assertTrue(self.profiler.is_running)
+        self.assertTrue(self.profiler._thread.is_alive())
+
+class TestReplyFetcher(TestCase):
+
+    def get_post(self, identifier):
+        reply = mock.Mock(identifier='reply/{}'.format(identifier))
+        return mock.Mock(identifier=identifier, **{'get_replies.return_value': [reply, None]})
+
+    def test_get_replies_many_fetches_each_missing_tree_once(self):
+        fetcher = ReplyFetcher(ttl_seconds=60, workers=4)
+        cached = self.get_post('author/cached')
+        fetcher.get_replies(cached)
+        posts = [cached] + [self.get_post('author/post-{}'.format(number)) for number in range(5)]
+        replies = fetcher.get_replies_many(posts)
+        self.assertEqual(sorted(replies), sorted(post.identifier for post in posts))
+        for post in posts:
+            self.assertEqual(post.get_replies.call_count, 1)
+            self.assertEqual(
+                [reply.identifier for reply in replies[post.identifier]],
+                ['reply/{}'.format(post.identifier)],
+            )
+        self.assertEqual(fetcher.stats['hits'], 1)
+        self.assertEqual(fetcher.stats['misses'], 6)
+        fetcher.get_replies_many(posts)
+        self.assertEqual(fetcher.stats['hits'], 7)
+
+class TestLoadShedder(TestCase):
+
+    def setUp(self):
+        self.shedder = LoadShedder(thresholds=[30, 10, 20], recover_ratio=0.5, enabled=True)
+        self.levels = []
+        self.shedder.listeners.append(self.levels.append)
+
+    def test_thresholds_up_and_down(self):
+        for lag, level in [
+            (5, 0), (10, 1), (19, 1), (20, 2), (30, 3), (100, 3),
+            # a stage is held until lag is under half its threshold
+            (16, 3), (15, 3), (14, 2), (11, 2), (10, 2), (9, 1), (5, 1), (4, 0),
+        ]:
+            self.assertEqual(self.shedder.update(lag), level, lag)
+        self.assertEqual(self.levels, [1, 2, 3, 2, 1, 0])
+
+    def test_stages(self):
+        self.assertFalse(self.shedder.skips_spam_check)
+        self.shedder.update(10)
+        self.assertTrue(self.shedder.skips_spam_check)
+        self.assertFalse(self.shedder.samples_sentences)
+        self.shedder.update(20)
+        self.assertTrue(self.shedder.samples_sentences)
+        self.assertFalse(self.shedder.priority_only)
+        self.shedder.update(30)
+        self.assertTrue(self.shedder.priority_only)
+
+    def test_jumps_several_stages_at_once(self):
+        self.shedder.update(45)
+        self.shedder.update(1)
+        self.assertEqual(self.levels, [3, 0])
+
+    def test_disabled(self):
+        shedder = LoadShedder(thresholds=[10, 20, 30], enabled=False)
+        self.assertEqual(shedder.update(100), 0)
+        self.assertEqual(shedder.lag, 100)
+
+    def test_priority_category(self):
+        steem_client = SteemClient(steem=object())
+        steem_client.load_shedder = self.shedder
+        priority = mock.Mock(category=sorted(PRIORITY_CATEGORIES)[0])
+        other = mock.Mock(category='not-a-priority-category')
+        self.shedder.update(20)
+        self.assertTrue(steem_client.is_priority_category(other))
+        self.shedder.update(30)
+        self.assertTrue(steem_client.is_priority_category(priority))
+        self.assertFalse(steem_client.is_priority_category(other))
+
+class TestSampleSentences(TestCase):
+
+    def test_short_posts_are_kept(self):
+        sentences = ['a', 'b', 'c']
+        self.assertEqual(sample_sentences(sentences, None), sentences)
+        self.assertEqual(sample_sentences(sentences, 3), sentences)
+        self.assertEqual(sample_sentences(sentences, 5), sentences)
+
+    def test_sample_keeps_first_and_last(self):
+        sentences = list(range(10))
+        self.assertEqual(sample_sentences(sentences, 1), [0])
+        self.assertEqual(sample_sentences(sentences, 2), [0, 9])
+        sample = sample_sentences(sentences, 4)
+        self.assertEqual(sample, [0, 3, 6, 9])
+        sample = sample_sentences(list(range(100)), 40)
+        self.assertEqual(len(set(sample)), 40)
+        self.assertEqual(sample, sorted(sample))
+
 class TestCommentOnPost(TestCase):
 
     def test_comment_on_post(self):
@@ -80,6 +694,74 @@ class TestPostSentiment(TestCase):
     def test_get_max_polarity(self):
         pass
 
+    def test_score_posts_matches_get_sentiment(self):
+        analyzer = PostSentimentAnalyzer()
+        posts = [
+            StoredPostBody(post_data['identifier'], post_data['body'])
+            for post_data in get_synthetic_corpus(20)
+        ] + [StoredPostBody('empty/post', '')]
+        results = analyzer.score_posts(posts)
+        for post, result in zip(posts[:-1], results):
+            sentiment = analyzer.get_sentiment(post)
+            self.assertEqual(result['identifier'], post.identifier)
+            self.assertEqual(result['sentences'], len(sentiment.polarities))
+            for key, value in sentiment.overall_polarity.items():
+                self.assertAlmostEqual(result[key], value, places=6)
+            self.assertAlmostEqual(
+                result['avg_normalized_polarity'], sentiment.avg_normalized_polarity, places=6
+            )
+            self.assertEqual(result['is_pos_outlier'], sentiment.is_pos_outlier)
+            self.assertEqual(result['is_neg_outlier'], sentiment.is_neg_outlier)
+        self.assertEqual(results[-1]['sentences'], 0)
+        self.assertFalse(results[-1]['is_pos_outlier'])
+
+    def test_rescore_stored_posts(self):
+        analyzer = PostSentimentAnalyzer()
+        mongo_steem = get_mongo_steem('memory', write_buffer_size=1, db_name='test_rescore')
+        corpus = get_synthetic_corpus(10)
+        for post_data in corpus:
+            post_data['is_pos_outlier'] = None
+            mongo_steem.posts.insert_one(dict(post_data))
+        mongo_steem.posts.insert_one({'id': 99, 'identifier': 'no/body'})
+        totals = mongo_steem.rescore_stored_posts(analyzer, batch_size=4)
+        self.assertEqual(totals['posts'], 10)
+        self.assertEqual(totals['skipped'], 1)
+        for post_data in corpus:
+            stored = mongo_steem.posts.find_one({'identifier': post_data['identifier']})
+            sentiment = analyzer.get_sentiment(StoredPostBody(post_data['identifier'], post_data['body']))
+            self.assertEqual(stored['is_pos_outlier'], sentiment.is_pos_outlier)
+            self.assertEqual(stored['overall_polarity'], sentiment.overall_polarity)
+
+    def test_sampled_score_is_marked(self):
+        analyzer = PostSentimentAnalyzer()
+        post = StoredPostBody('author/sampled', ' '.join(
+            'Sentence number {} is great.'.format(number) for number in range(10)
+        ))
+        analyzer.sentence_limit = 4
+        sampled = analyzer.get_sentiment(post)
+        self.assertEqual(sampled.sentence_sample, 4)
+        self.assertEqual(len(sampled.polarities), 4)
+        self.assertEqual(analyzer.to_mongo(post)['sentence_sample'], 4)
+        self.assertIs(analyzer.get_sentiment(post), sampled)
+        analyzer.sentence_limit = None
+        full = analyzer.get_sentiment(post)
+        self.assertIsNone(full.sentence_sample)
+        self.assertEqual(len(full.polarities), 10)
+        self.assertNotIn('sentence_sample', analyzer.to_mongo(post))
+
+    def test_rescore_clears_sentence_sample(self):
+        analyzer = PostSentimentAnalyzer()
+        mongo_steem = get_mongo_steem('memory', write_buffer_size=1, db_name='test_rescore_sampled')
+        post_data = get_synthetic_corpus(1)[0]
+        post_data['sentence_sample'] = 4
+        post_data['created'] = datetime.datetime.now()
+        mongo_steem.posts.insert_one(dict(post_data))
+        totals = mongo_steem.rescore_stored_posts(
+            analyzer, query=mongo_steem.get_sampled_posts_query()
+        )
+        self.assertEqual(totals['posts'], 1)
+        self.assertNotIn('sentence_sample', mongo_steem.posts.find_one({'id': post_data['id']}))
+
     def test_to_csv(self):
         pass
 
@@ -89,6 +771,68 @@ class TestPostSentiment(TestCase):
     def test_is_pos_outlier(self):
         pass
 
+class TestScoringPool(TestCase):
+
+    def setUp(self):
+        self.analyzer = PostSentimentAnalyzer()
+        self.posts = [
+            StoredPostBody(post_data['identifier'], post_data['body'])
+            for post_data in get_synthetic_corpus(8)
+        ]
+
+    def test_ordered_results_match_get_sentiment(self):
+        pool = ScoringPool(workers=2, ordered=True, max_pending=3)
+        self.addCleanup(pool.close)
+        scored = list(pool.score(iter(self.posts), self.analyzer))
+        self.assertEqual(scored, self.posts)
+        expected = PostSentimentAnalyzer()
+        for post in scored:
+            self.assertEqual(
+                self.analyzer.get_sentiment(post).avg_normalized_polarity,
+                expected.get_sentiment(post).avg_normalized_polarity,
+            )
+
+    def test_scored_posts_are_counted_in_the_parent(self):
+        pool = ScoringPool(workers=2, max_pending=3)
+        self.addCleanup(pool.close)
+        before = METRICS.get('kettle_posts_scored_total') or 0
+        list(pool.score(iter(self.posts), self.analyzer))
+        pool.score_one(self.posts[0], self.analyzer)
+        self.assertEqual(METRICS.get('kettle_posts_scored_total'), before + len(self.posts) + 1)
+
+    def test_unordered_results_cover_every_post(self):
+        pool = ScoringPool(workers=2, ordered=False, max_pending=3)
+        self.addCleanup(pool.close)
+        scored = list(pool.score(iter(self.posts), self.analyzer))
+        self.assertEqual(sorted(scored), sorted(self.posts))
+
+    def test_close_while_input_is_blocked(self):
+        pool = ScoringPool(workers=1, max_pending=2, poll_seconds=0.01)
+        released = threading.Event()
+        scored = queue.Queue()
+
+        def posts():
+            yield self.posts[0]
+            yield self.posts[1]
+            released.wait()
+            yield self.posts[2]
+
+        def consume():
+            for post in pool.score(posts(), self.analyzer):
+                scored.put(post)
+
+        consumer = threading.Thread(target=consume, daemon=True)
+        consumer.start()
+        self.assertEqual(scored.get(timeout=30), self.posts[0])
+        closer = threading.Thread(target=pool.close, daemon=True)
+        closer.start()
+        closer.join(timeout=10)
+        self.assertFalse(closer.is_alive())
+        released.set()
+        consumer.join(timeout=10)
+        self.assertFalse(consumer.is_alive())
+        self.assertTrue(scored.empty())
+
 def TestSteemStentimentCommenterRun(TestCase):
     pass
 